@@ -0,0 +1,455 @@
+"""
+Benchmarks for the map build.
+
+Run from the repository root, like map.py:
+
+    python data_to_map/bench.py geometry [--repeat N] [--world]
+    python data_to_map/bench.py synthetic [--rows N ...] [--targets ...]
+    python data_to_map/bench.py compare [--stage STAGE]
+    python data_to_map/bench.py filter [--rows N ...] [--states N]
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import subprocess
+from pathlib import Path
+
+import numpy
+import pandas
+from bokeh.document import Document
+from bokeh.models import Plot, MultiPolygons, ColumnDataSource
+
+import map as spa_map
+
+
+def best_of(repeat, func, *args):
+    """Run `func(*args)` `repeat` times; return the fastest time and the
+    last result."""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def serialized_size(source):
+    """Size in bytes of the document JSON Bokeh would embed for a plot
+    drawing `source`."""
+    plot = Plot()
+    plot.add_glyph(source, MultiPolygons(xs='xs', ys='ys'))
+    doc = Document()
+    doc.add_root(plot)
+    return len(doc.to_json_string().encode('utf-8'))
+
+
+def topology_source(gdf):
+    """The borders in `gdf` as shared arcs, quantized as the country
+    map's finest level of detail has them, but not simplified."""
+    zoom = spa_map.COUNTRY_LOD_ZOOMS[-1]
+    quantum = spa_map.meters_per_pixel(zoom) * spa_map.COUNTRY_QUANTUM_PIXELS
+    arcs, geometries = spa_map.build_arcs(gdf['geometry'].values, quantum)
+    return ColumnDataSource(
+        data=spa_map.encode_topology(arcs, geometries, quantum)
+    )
+
+
+def bench_geometry(args):
+    frames = [('africa', spa_map.load_geojson())]
+    if args.world:
+        frames.append(('world', spa_map.load_geojson(region=None)))
+
+    rows = []
+    for label, gdf in frames:
+        geometry = gdf['geometry']
+        geometry_values = geometry.values
+        timings = [
+            ('rings, lists', best_of(
+                args.repeat, spa_map.multipolygons_to_xs_ys, geometry)),
+            ('rings, arrays', best_of(
+                args.repeat, spa_map.multipolygons_to_xs_ys_arrays,
+                geometry_values)),
+            ('source, GeoJSON', best_of(
+                args.repeat, spa_map.geodf_patches_to_geods, gdf)),
+            ('source, columns', best_of(
+                args.repeat, spa_map.geodf_patches_to_cds, gdf)),
+            ('source, arcs', best_of(args.repeat, topology_source, gdf)),
+        ]
+        for name, (seconds, result) in timings:
+            size = ''
+            if name.startswith('source'):
+                size = '{:,}'.format(serialized_size(result))
+            rows.append((label, len(gdf), name, seconds, size))
+
+    print('{:<8} {:>6} {:<16} {:>10} {:>14}'.format(
+        'subset', 'rows', 'path', 'best (ms)', 'embed (bytes)'))
+    for label, n, name, seconds, size in rows:
+        print('{:<8} {:>6} {:<16} {:>10.1f} {:>14}'.format(
+            label, n, name, seconds * 1000, size))
+
+
+BENCH_RESULTS_PATH = 'data_to_map/.bench-results.jsonl'
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December']
+
+
+def random_points_in(countries, n, rng):
+    """
+    Return the longitudes, latitudes and country names of `n` random
+    points, spread uniformly over the given countries.
+    """
+    lon_lo, lat_lo, lon_hi, lat_hi = countries.to_crs('EPSG:4326').total_bounds
+    lons, lats, names = [], [], []
+    found = 0
+    while found < n:
+        batch = pandas.DataFrame({
+            'LONG': rng.uniform(lon_lo, lon_hi, 2 * (n - found) + 100),
+            'LAT': rng.uniform(lat_lo, lat_hi, 2 * (n - found) + 100),
+        })
+        located = spa_map.locate_protests(batch, countries)
+        inside = located.notna().values
+        lons.append(batch['LONG'].values[inside])
+        lats.append(batch['LAT'].values[inside])
+        names.append(located.values[inside])
+        found += inside.sum()
+    return (numpy.concatenate(lons)[:n], numpy.concatenate(lats)[:n],
+            numpy.concatenate(names)[:n])
+
+
+def synthetic_protests(sample, countries, n, rng):
+    """
+    Make `n` protests with the same columns as the `sample` sheet.
+
+    Protests happen at a few random localities inside `countries`,
+    some much busier than others, so that, as in the real sheet, many
+    protests share coordinates. Each filter column's values, which may
+    list several comma-separated tags, are drawn from the distribution
+    of that column's values in `sample`. Descriptions are random runs of
+    the words in `sample`'s descriptions, a few times longer than most
+    real ones.
+    """
+    n_localities = max(10, n // 10)
+    loc_lon, loc_lat, loc_country = random_points_in(
+        countries, n_localities, rng
+    )
+    busy = 1 / numpy.arange(1, n_localities + 1)
+    locality = rng.choice(n_localities, n, p=busy / busy.sum())
+
+    country = loc_country[locality]
+    years = rng.integers(2000, 2021, n)
+    months = rng.integers(0, 12, n)
+    days = rng.integers(1, 29, n)
+    dates = pandas.to_datetime(
+        {'year': years, 'month': months + 1, 'day': days}
+    ).dt.strftime('%d-%b-%y')
+
+    protests = pandas.DataFrame({
+        'Protest Name': (pandas.Series(country) + '-' +
+                         pandas.Series(MONTHS).values[months] + '-' +
+                         years.astype(str)),
+        'Country Name': country,
+        'Date': dates.values,
+        'Locality Name': ['Locality ' + str(i) for i in locality],
+        'School Name': ['School ' + str(i)
+                        for i in rng.integers(0, max(10, n // 4), n)],
+    })
+
+    words = numpy.array(' '.join(
+        sample['Description of Protest'].dropna().astype(str)
+    ).split())
+    n_descriptions = min(n, 5000)
+    lengths = rng.integers(40, 120, n_descriptions)
+    descriptions = numpy.array([' '.join(rng.choice(words, k))
+                                for k in lengths])
+    protests['Description of Protest'] = descriptions[
+        rng.integers(0, n_descriptions, n)
+    ]
+    protests['Primary Source'] = [
+        'https://example.org/news/' + str(i) for i in range(n)
+    ]
+    protests['Additional Sources'] = ''
+    protests['LAT'] = loc_lat[locality]
+    protests['LONG'] = loc_lon[locality]
+
+    for col in sample.columns:
+        if spa_map.is_filter_column(col):
+            values = sample[col].astype(object).values
+            protests[col] = values[rng.integers(0, len(values), n)]
+
+    protests['unique-key'] = (
+        protests['Country Name'] + '-' +
+        (protests.groupby('Country Name').cumcount() + 1).astype(str)
+    )
+    return protests[list(sample.columns)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_build(root, targets, profile):
+    os.chdir(root)
+    spa_map.main(targets=targets, profile=profile)
+
+
+def build_site(root, targets):
+    """
+    Make a copy of the jekyll site's skeleton in `root`, with links to
+    the real country data, and run a profiled build in it, next to the
+    protest sheet already saved there. Returns the profile's records.
+    """
+    root = Path(root)
+    for path in [spa_map.COUNTRIES_PATH, spa_map.GEOJSON_PATH]:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        os.symlink(Path(path).resolve(), root / path)
+    for path in ['_countries', '_protests', '_includes', 'assets/data']:
+        (root / 'docs' / path).mkdir(parents=True, exist_ok=True)
+    for path in ['index.markdown', 'full-protest-map.markdown']:
+        (root / 'docs' / path).touch()
+
+    # Build in a fresh interpreter, so that the peak memory use recorded
+    # is the build's own, not that of making the data or of earlier runs.
+    profile = root / 'profile.jsonl'
+    build = multiprocessing.get_context('spawn').Process(
+        target=run_build, args=(root, targets, profile)
+    )
+    build.start()
+    build.join()
+    if build.exitcode != 0:
+        raise RuntimeError(f'build in {root} failed')
+
+    with open(profile, encoding='utf-8') as ip:
+        return [json.loads(line) for line in ip]
+
+
+def bench_synthetic(args):
+    rng = numpy.random.default_rng(args.seed)
+    sample = pandas.read_csv(spa_map.PROTESTS_PATH, dtype=str)
+    countries = spa_map.load_geojson()
+    targets = set(args.targets) if args.targets else None
+    commit = git_commit()
+
+    results = []
+    for n in args.rows:
+        print(f'Generating {n:,} protests...')
+        protests = synthetic_protests(sample, countries, n, rng)
+        with tempfile.TemporaryDirectory(prefix='spa-bench-') as root:
+            path = Path(root) / spa_map.PROTESTS_PATH
+            path.parent.mkdir(parents=True)
+            protests.to_csv(path, index=False)
+            del protests
+
+            print(f'Building with {n:,} protests...')
+            for record in build_site(root, targets):
+                record.update(rows=n, commit=commit,
+                              targets=sorted(targets or spa_map.BUILD_TARGETS))
+                results.append(record)
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'a', encoding='utf-8') as op:
+        for record in results:
+            op.write(json.dumps(record) + '\n')
+
+    print_table(results, ['rows', 'stage'])
+
+
+def print_table(records, keys):
+    """Print the given records' costs, one per line, labelled by the
+    values of `keys`. CPU time spent in worker processes, and the peak
+    RSS of the largest worker, are shown apart from the build's own."""
+    print(('{:<18} ' * len(keys) +
+           '{:>10} {:>10} {:>14} {:>13} {:>15} {:>14}').format(
+        *keys, 'wall (s)', 'cpu (s)', 'child cpu (s)', 'peak RSS (MB)',
+        'child RSS (MB)', 'output (bytes)'))
+    for r in records:
+        child_rss = r.get('children_peak_rss_kb')
+        print(('{:<18} ' * len(keys) +
+               '{:>10.3f} {:>10.3f} {:>14.3f} {:>13.1f} {:>15} {:>14}')
+              .format(*[str(r.get(k)) for k in keys], r['wall_s'], r['cpu_s'],
+                      r.get('children_cpu_s', 0), r['peak_rss_kb'] / 1024,
+                      '' if child_rss is None
+                      else '{:.1f}'.format(child_rss / 1024),
+                      '{:,}'.format(r['bytes']) if 'bytes' in r else ''))
+
+
+def bench_compare(args):
+    """Show one stage's results across the commits that were benchmarked,
+    using each commit's latest results for each size."""
+    with open(args.output, encoding='utf-8') as ip:
+        records = [json.loads(line) for line in ip]
+    latest = {}
+    for r in records:
+        if r['stage'] == args.stage:
+            latest[r['rows'], r['commit']] = r
+    print_table(sorted(latest.values(),
+                       key=lambda r: (r['rows'], r['build'])),
+                ['rows', 'commit'])
+
+
+# Times `bitsetIndices`, from the point map's filter callback, on each of
+# the filter states, after one untimed call that decodes the bitsets.
+FILTER_TIMER_JS = """
+const fs = require('fs');
+const window = globalThis;
+const {bitsets, states, nrows} = JSON.parse(
+    fs.readFileSync(process.argv[2], 'utf8'));
+""" + spa_map.BITSET_FILTER_JS + """
+let start = performance.now();
+bitsetIndices({}, bitsets, nrows);
+const decode = performance.now() - start;
+const times = [];
+let matched = 0;
+for (const state of states) {
+    start = performance.now();
+    matched += bitsetIndices(state, bitsets, nrows).length;
+    times.push(performance.now() - start);
+}
+console.log(JSON.stringify({decode, times, matched}));
+"""
+
+
+def random_filter_states(tags, n, rng):
+    """
+    Make `n` states of the point map's filters, as its callbacks get
+    them: in each, about half the filters have one to three of their
+    tags selected, and the rest have none.
+    """
+    states = []
+    for _ in range(n):
+        state = {}
+        for col, tag_column in tags.items():
+            vocabulary = tag_column.vocabulary
+            if vocabulary and rng.random() < 0.5:
+                k = int(rng.integers(1, min(3, len(vocabulary)) + 1))
+                state[col] = rng.choice(vocabulary, k, replace=False).tolist()
+            else:
+                state[col] = []
+        states.append(state)
+    return states
+
+
+def bench_filter(args):
+    """
+    Time the point map's filter callback on synthetic protest sheets.
+
+    No browser is needed: the callback's `bitsetIndices` runs in Node.js,
+    whose V8 engine is Chrome's, on the bitsets `Map.filter_bitsets`
+    would embed. Redrawing the plot afterwards isn't included.
+    """
+    node = shutil.which('node')
+    if node is None:
+        sys.exit("bench.py filter needs Node.js: no `node` on the PATH")
+
+    rng = numpy.random.default_rng(args.seed)
+    sample = pandas.read_csv(spa_map.PROTESTS_PATH, dtype=str)
+    countries = spa_map.load_geojson()
+
+    print('{:>8} {:>14} {:>11} {:>12} {:>10} {:>10}'.format(
+        'rows', 'bitsets (B)', 'decode (ms)', 'median (ms)', 'max (ms)',
+        'matched'))
+    for n in args.rows:
+        protests = synthetic_protests(sample, countries, n, rng)
+        tags = {col: spa_map.TagColumn.parse(protests[col])
+                for col in protests.columns if spa_map.is_filter_column(col)}
+        bitsets = {col: tag_column.bitsets()
+                   for col, tag_column in tags.items()}
+        states = random_filter_states(tags, args.states, rng)
+        del protests
+
+        with tempfile.TemporaryDirectory(prefix='spa-bench-') as root:
+            payload = Path(root) / 'payload.json'
+            with open(payload, 'w', encoding='utf-8') as op:
+                json.dump(dict(bitsets=bitsets, states=states, nrows=n), op)
+            timer = Path(root) / 'timer.js'
+            timer.write_text(FILTER_TIMER_JS, encoding='utf-8')
+            result = json.loads(subprocess.run(
+                [node, str(timer), str(payload)], stdout=subprocess.PIPE,
+                universal_newlines=True, check=True
+            ).stdout)
+
+        times = result['times']
+        print('{:>8} {:>14,} {:>11.2f} {:>12.3f} {:>10.3f} {:>10.0f}'.format(
+            n, len(json.dumps(bitsets)), result['decode'],
+            numpy.median(times), max(times),
+            result['matched'] / len(times)))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    geometry = commands.add_parser(
+        'geometry',
+        help="compare the list and array paths from shapely to Bokeh"
+    )
+    geometry.add_argument('--repeat', type=int, default=5,
+                          help="timing runs per path; the best is kept")
+    geometry.add_argument('--world', action='store_true',
+                          help="also benchmark every country, not just "
+                               "the African subset the map uses")
+    geometry.set_defaults(run=bench_geometry)
+
+    synthetic = commands.add_parser(
+        'synthetic',
+        help="build the site from synthetic protest sheets of several "
+             "sizes, and record the cost of each build stage"
+    )
+    synthetic.add_argument('--rows', type=int, nargs='+',
+                           default=[1000, 10000, 100000, 1000000],
+                           help="numbers of protests to generate")
+    synthetic.add_argument('--targets', nargs='+',
+                           choices=sorted(spa_map.BUILD_TARGETS),
+                           help="build just these targets (default: all)")
+    synthetic.add_argument('--seed', type=int, default=0)
+    synthetic.add_argument('--output', default=BENCH_RESULTS_PATH,
+                           help="file to append the results to, as JSON "
+                                "lines tagged with the commit")
+    synthetic.set_defaults(run=bench_synthetic)
+
+    compare = commands.add_parser(
+        'compare',
+        help="compare the synthetic benchmark results of each commit"
+    )
+    compare.add_argument('--stage', default='build',
+                         help="build stage to compare (default: the "
+                              "whole build)")
+    compare.add_argument('--output', default=BENCH_RESULTS_PATH,
+                         help="file the results were saved to")
+    compare.set_defaults(run=bench_compare)
+
+    filter_ = commands.add_parser(
+        'filter',
+        help="time the point map's filter callback, in Node.js, on "
+             "synthetic protest sheets of several sizes"
+    )
+    filter_.add_argument('--rows', type=int, nargs='+',
+                         default=[1000, 10000, 100000, 1000000],
+                         help="numbers of protests to generate")
+    filter_.add_argument('--states', type=int, default=200,
+                         help="random filter states to time the callback "
+                              "on, per size")
+    filter_.add_argument('--seed', type=int, default=0)
+    filter_.set_defaults(run=bench_filter)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    args.run(args)
@@ -1,22 +1,34 @@
-import math
 import os
 import re
 import time
 import json
+import hashlib
+import inspect
+import base64
 import sys
 import signal
+import argparse
+import cProfile
+import resource
+import multiprocessing
+import multiprocessing.util
+from contextlib import contextmanager
 from pathlib import Path
-from collections import defaultdict, Counter
+from collections import Counter
 
 # from shapely.geometry import Point, Polygon
+import numpy
 import pandas
 import geopandas as gpd
 import shapely
+import shapely.geometry
+import shapely.wkb
 # from bokeh.io import show, output_file
 from bokeh.models import (
     LinearColorMapper,
     Circle,
     Scatter,
+    Text,
     MultiPolygons,
     GeoJSONDataSource,
     HoverTool,
@@ -26,12 +38,14 @@ from bokeh.models import (
     Tabs,
     WMTSTileSource,
     CustomJS,
+    CustomJSTransform,
     Div,
     CheckboxGroup,
     # CheckboxButtonGroup,
     # MultiChoice,
     Button,
     ColumnDataSource,
+    CDSView,
     TapTool,
     OpenURL,
     Toggle,
@@ -47,12 +61,21 @@ from bokeh.embed import (
     # file_html,
     components,
 )
+from bokeh.core.json_encoder import serialize_json
+from bokeh.util.serialization import transform_column_source_data
 
+import mvt
+import watch
+import schedule
+import thumbnails
 
-# Currently unused, but preserved here for reference.
+
+# Works on scalars or NumPy arrays. Projecting an array of coordinates
+# this way is much faster than reading them back out of an array of
+# shapely points.
 def lat_lon_to_web_mercator(lon, lat):
     x = lon * 20037508.34 / 180
-    y = math.log(math.tan((90 + lat) * math.pi / 360)) / (math.pi / 180)
+    y = numpy.log(numpy.tan((90 + lat) * numpy.pi / 360)) / (numpy.pi / 180)
     y = y * 20037508.34 / 180
     return x, y
 
@@ -83,6 +106,245 @@ def multipolygons_to_xs_ys(multipolygons):
     return geo_xs, geo_ys
 
 
+def multipolygon_rings(multipolygons):
+    """
+    Return the coordinates of all the rings of the given polygons and
+    multipolygons, one ring after another, as an (n, 2) array, along
+    with the number of coordinates in each ring, the polygon that each
+    ring belongs to, and the geometry that each polygon belongs to.
+
+    With shapely 2, the coordinates of all the rings of all the
+    geometries come out in one bulk call. Older versions of shapely can
+    only give us one ring's coordinates at a time, but at least each
+    ring is copied as an array, and never as a list of tuples.
+    """
+    if hasattr(shapely, 'get_coordinates'):
+        # Geometry index for each polygon, and polygon index for each
+        # ring.
+        polygons, geo_ix = shapely.get_parts(
+            numpy.asarray(multipolygons), return_index=True
+        )
+        rings, poly_ix = shapely.get_rings(polygons, return_index=True)
+        coords = shapely.get_coordinates(rings)
+        counts = shapely.get_num_coordinates(rings)
+    else:
+        geo_ix, poly_ix, rings = [], [], []
+        n_polygons = 0
+        for i, m in enumerate(multipolygons):
+            parts = [m] if isinstance(m, shapely.geometry.Polygon) else m.geoms
+            for poly in parts:
+                geo_ix.append(i)
+                rings.append(poly.exterior)
+                rings.extend(poly.interiors)
+                poly_ix.extend([n_polygons] * (1 + len(poly.interiors)))
+                n_polygons += 1
+        geo_ix = numpy.asarray(geo_ix, dtype=int)
+        poly_ix = numpy.asarray(poly_ix, dtype=int)
+        ring_coords = [numpy.asarray(ring.coords)[:, :2] for ring in rings]
+        counts = numpy.array([len(rc) for rc in ring_coords], dtype=int)
+        coords = (numpy.concatenate(ring_coords) if ring_coords
+                  else numpy.empty((0, 2)))
+    return coords, counts, poly_ix, geo_ix
+
+
+def multipolygons_to_xs_ys_arrays(multipolygons):
+    """
+    Like `multipolygons_to_xs_ys`, but each ring's xs and ys are NumPy
+    arrays, sliced out of one big coordinate buffer at the ring offsets,
+    instead of lists built a coordinate at a time.
+    """
+    coords, counts, poly_ix, geo_ix = multipolygon_rings(multipolygons)
+
+    offsets = numpy.cumsum(counts)[:-1]
+    ring_xs = numpy.split(numpy.ascontiguousarray(coords[:, 0]), offsets)
+    ring_ys = numpy.split(numpy.ascontiguousarray(coords[:, 1]), offsets)
+
+    geo_xs = [[] for _ in range(len(multipolygons))]
+    geo_ys = [[] for _ in range(len(multipolygons))]
+    poly_xs, poly_ys = {}, {}
+    for ring_ix, p_ix in enumerate(poly_ix):
+        if p_ix not in poly_xs:
+            poly_xs[p_ix], poly_ys[p_ix] = [], []
+            geo_xs[geo_ix[p_ix]].append(poly_xs[p_ix])
+            geo_ys[geo_ix[p_ix]].append(poly_ys[p_ix])
+        poly_xs[p_ix].append(ring_xs[ring_ix])
+        poly_ys[p_ix].append(ring_ys[ring_ix])
+    return geo_xs, geo_ys
+
+
+def build_arcs(multipolygons, quantum):
+    """
+    Break the rings of the given polygons and multipolygons into arcs,
+    in the manner of TopoJSON, so that a border between two countries
+    is stored once rather than once for each. Coordinates are first
+    rounded to the nearest multiple of `quantum`, and the arcs hold
+    those multiples.
+
+    A ring is cut wherever it meets another ring and they part ways:
+    at every point that has different neighbors along one ring than
+    along another. Arcs that run through the same points, in either
+    direction, are kept once. Returns the arcs, each an (n, 2) integer
+    array, and for each geometry, a list of its polygons, each a list
+    of its rings, each a list of the arcs that make it up. As in
+    TopoJSON, arc `~i` is arc `i` reversed.
+
+    Rings that round away to fewer than three points are dropped, along
+    with the polygons whose exteriors do.
+    """
+    coords, counts, poly_ix, geo_ix = multipolygon_rings(multipolygons)
+    points = numpy.round(coords / quantum).astype(numpy.int64)
+
+    # Drop repeated points, including the point that closes each ring.
+    rings = []
+    for ring in numpy.split(points, numpy.cumsum(counts)[:-1]):
+        keep = numpy.ones(len(ring), dtype=bool)
+        keep[1:] = (ring[1:] != ring[:-1]).any(axis=1)
+        ring = ring[keep]
+        if len(ring) > 1 and (ring[-1] == ring[0]).all():
+            ring = ring[:-1]
+        rings.append(ring)
+
+    lengths = numpy.array([len(ring) for ring in rings], dtype=int)
+    starts = numpy.cumsum(lengths) - lengths
+    flat = (numpy.concatenate(rings) if rings
+            else numpy.empty((0, 2), dtype=numpy.int64))
+
+    # Number each distinct point, and find each point's neighbors along
+    # its ring, which wraps around.
+    keys = (flat[:, 0] << 32) + flat[:, 1]
+    _, point_ids = numpy.unique(keys, return_inverse=True)
+    point_ids = point_ids.ravel()
+    at = numpy.arange(len(flat))
+    first = numpy.repeat(starts, lengths)
+    last = first + numpy.repeat(lengths, lengths) - 1
+    prev_ids = point_ids[numpy.where(at == first, last, at - 1)]
+    next_ids = point_ids[numpy.where(at == last, first, at + 1)]
+    neighbors = numpy.column_stack([
+        point_ids,
+        numpy.minimum(prev_ids, next_ids),
+        numpy.maximum(prev_ids, next_ids),
+    ])
+    ids, times = numpy.unique(numpy.unique(neighbors, axis=0)[:, 0],
+                              return_counts=True)
+    junction = numpy.isin(point_ids, ids[times > 1])
+
+    arcs = []
+    arc_index = {}
+
+    def arc_ref(ring_ids, ring_points):
+        key = ring_ids.tobytes()
+        if key in arc_index:
+            return arc_index[key]
+        reverse_key = ring_ids[::-1].tobytes()
+        if reverse_key in arc_index:
+            return ~arc_index[reverse_key]
+        arc_index[key] = len(arcs)
+        arcs.append(ring_points)
+        return arc_index[key]
+
+    ring_arcs = []
+    for start, length in zip(starts, lengths):
+        if length < 3:
+            ring_arcs.append(None)
+            continue
+        ring = slice(start, start + length)
+        ids, ring_points = point_ids[ring], flat[ring]
+        cuts = numpy.flatnonzero(junction[ring])
+        if len(cuts) == 0:
+            cuts = numpy.array([0])
+
+        # Start the ring at a cut, close it, and split it at the cuts.
+        order = numpy.roll(numpy.arange(length), -cuts[0])
+        order = numpy.append(order, order[0])
+        bounds = numpy.append(cuts - cuts[0], length)
+        ring_arcs.append([
+            arc_ref(ids[order[a:b + 1]], ring_points[order[a:b + 1]])
+            for a, b in zip(bounds[:-1], bounds[1:])
+        ])
+
+    geometries = [[] for _ in range(len(multipolygons))]
+    polygons = {}
+    for ring_ix, p_ix in enumerate(poly_ix):
+        if p_ix not in polygons:
+            if ring_arcs[ring_ix] is None:
+                polygons[p_ix] = None
+                continue
+            polygons[p_ix] = []
+            geometries[geo_ix[p_ix]].append(polygons[p_ix])
+        if polygons[p_ix] is not None and ring_arcs[ring_ix] is not None:
+            polygons[p_ix].append(ring_arcs[ring_ix])
+    return arcs, geometries
+
+
+def simplify_arcs(arcs, tolerance, scale=1):
+    """
+    Simplify each of the arcs from `build_arcs` to within `tolerance`,
+    keeping its ends, so that neighboring countries are simplified
+    alike. Then divide the coordinates by `scale`, rounding them, to
+    make them coarser still. An arc that closes a ring on its own is
+    left as it is if simplifying it would leave less than a triangle.
+    """
+    simplified = []
+    for arc in arcs:
+        if len(arc) > 2:
+            line = shapely.geometry.LineString(arc)
+            coarse = numpy.asarray(
+                line.simplify(tolerance, preserve_topology=False).coords
+            )
+            closed = (arc[0] == arc[-1]).all()
+            if not closed or len(coarse) >= 4:
+                arc = coarse
+        arc = numpy.round(numpy.asarray(arc) / scale).astype(numpy.int64)
+        keep = numpy.ones(len(arc), dtype=bool)
+        keep[1:-1] = (arc[1:-1] != arc[:-2]).any(axis=1)
+        simplified.append(arc[keep])
+    return simplified
+
+
+def encode_topology(arcs, geometries, quantum):
+    """
+    Pack the arcs and geometries from `build_arcs` into a few flat
+    integer arrays, as the single row of a ColumnDataSource's data. The
+    columns are:
+
+    - `coords`: the points of the arcs, one arc after another, as
+      interleaved x and y differences from the point before (the first
+      from the origin), in the smallest integer type that holds them;
+    - `arcs`: the number of points in each arc;
+    - `shapes`: for each geometry, its number of polygons, then for
+      each polygon its number of rings, then for each ring its number
+      of arcs and their indices;
+    - `offsets`: the start of each geometry in `shapes`;
+    - `quantum`: the size in meters of a unit of `coords`.
+
+    Bokeh sends the arrays to the browser as binary, and `TOPOLOGY_JS`
+    decodes them.
+    """
+    points = (numpy.concatenate(arcs) if arcs
+              else numpy.empty((0, 2), dtype=numpy.int64))
+    deltas = numpy.diff(points, axis=0, prepend=[[0, 0]]).ravel()
+    largest = numpy.abs(deltas).max() if len(deltas) else 0
+    dtype = numpy.int16 if largest < 2 ** 15 else numpy.int32
+
+    shapes, offsets = [], []
+    for polygons in geometries:
+        offsets.append(len(shapes))
+        shapes.append(len(polygons))
+        for rings in polygons:
+            shapes.append(len(rings))
+            for ring in rings:
+                shapes.append(len(ring))
+                shapes.extend(ring)
+
+    return {
+        'coords': [deltas.astype(dtype)],
+        'arcs': [numpy.array([len(arc) for arc in arcs], dtype=numpy.int32)],
+        'shapes': [numpy.array(shapes, dtype=numpy.int32)],
+        'offsets': [numpy.array(offsets, dtype=numpy.int32)],
+        'quantum': [float(quantum)],
+    }
+
+
 # If the world were a good place, this function would not be
 # needed, and we could pass the geopandas dataframe straight
 # to GeoJSONDataSource. That ALMOST works. But for some
@@ -101,6 +363,29 @@ def geodf_patches_to_geods(geodf):
     )
 
 
+def geodf_patches_to_cds(geodf, columns=None):
+    """
+    A faster alternative to `geodf_patches_to_geods`. The rings go into
+    a ColumnDataSource as NumPy arrays, which Bokeh sends to the browser
+    as binary, with no detour through GeoJSON text or nested lists.
+    Only the given `columns` go along with them, or every column if
+    `columns` is None.
+    """
+    geo_xs, geo_ys = multipolygons_to_xs_ys_arrays(geodf['geometry'].values)
+    data = {'xs': geo_xs, 'ys': geo_ys}
+    if columns is None:
+        columns = geodf.columns
+    for col in columns:
+        if col == 'geometry':
+            continue
+        values = geodf[col].values
+        if values.dtype.kind == 'f':
+            # Infinity isn't a valid JSON value; see above.
+            values = numpy.where(numpy.isinf(values), numpy.nan, values)
+        data[col] = values
+    return ColumnDataSource(data=data)
+
+
 def safe_lt(comp):
     def comp_func(val):
         try:
@@ -139,15 +424,40 @@ def protest_name_urlsafe(name):
     return perma
 
 
-def load_geojson(simplify_tol=None):
-    gdf = gpd.read_file('data_to_map/data/gadm28_countries.geojson')
-    gdf = gdf[gdf['geometry'].notna()]
+GEOJSON_PATH = 'data_to_map/data/gadm28_countries.geojson'
+GEOMETRY_CACHE_DIR = 'data_to_map/.cache'
+
+# Bump this when load_geojson changes what it does to the geometry, so
+# that caches written by older code are ignored.
+GEOMETRY_CACHE_VERSION = 1
+
+
+def load_geojson(simplify_tol=None, region='Africa', preserve_topology=False,
+                 cache_dir=GEOMETRY_CACHE_DIR):
+    """
+    Load country borders, keeping only countries in `region` (or the
+    whole world if `region` is None), projected to web mercator and
+    optionally simplified.
+
+    The result is cached in `cache_dir` as WKB, keyed by a hash of the
+    source file and the arguments, so that a warm start skips parsing
+    and reprojecting the GeoJSON. Pass `cache_dir=None` to bypass the
+    cache.
+    """
+    if cache_dir is not None:
+        cache_path = geometry_cache_path(
+            cache_dir, file_digest(GEOJSON_PATH), region,
+            simplify_tol, preserve_topology
+        )
+        if cache_path.exists():
+            return load_geometry_cache(cache_path)
 
-    # For all countries, drop just Antarctica:
-    # gdf = gdf[gdf['name_engli'] != 'Antarctica']
+    gdf = gpd.read_file(GEOJSON_PATH)
+    gdf = gdf[gdf['geometry'].notna()]
 
     # For just africa drop other continents:
-    gdf = gdf[gdf['unregion2'] == 'Africa']
+    if region is not None:
+        gdf = gdf[gdf['unregion2'] == region]
 
     gdf['name'] = gdf['name_engli']
     gdf['perma'] = gdf['name'].apply(country_name_perma)
@@ -161,35 +471,181 @@ def load_geojson(simplify_tol=None):
         gdf = gdf[gdf['geometry'].apply(can_be_simplified)]
         gdf['geometry'] = gdf['geometry'].simplify(
             simplify_tol,
-            preserve_topology=False
+            preserve_topology=preserve_topology
         )
+
+    if cache_dir is not None:
+        save_geometry_cache(cache_path, gdf)
     return gdf
 
 
-def load_protests():
-    protests = pandas.read_csv('data_to_map/data/protests.csv')
-    protests_wrong_data = protests[
-        # protests.LONG.apply(safe_lt(-20)) |
-        protests.LONG.isna() |
-        protests.LAT.isna()
-    ]
+def geometry_cache_path(cache_dir, source_digest, region, simplify_tol,
+                        preserve_topology):
+    key = json.dumps({
+        'version': GEOMETRY_CACHE_VERSION,
+        'source': source_digest,
+        'region': region,
+        'simplify_tol': simplify_tol,
+        'preserve_topology': preserve_topology,
+    }, sort_keys=True)
+    name = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    return Path(cache_dir) / f'countries-{name}.npz'
+
+
+def save_geometry_cache(path, gdf):
+    """
+    Write `gdf` to `path` as one buffer of concatenated WKB geometries,
+    the offsets where each one ends, and the other columns as JSON.
+    """
+    if hasattr(shapely, 'to_wkb'):
+        blobs = shapely.to_wkb(numpy.asarray(gdf['geometry']))
+    else:
+        blobs = [geom.wkb for geom in gdf['geometry']]
+    ends = numpy.cumsum([len(blob) for blob in blobs], dtype=numpy.int64)
+    attributes = pandas.DataFrame(gdf.drop(columns='geometry'))
+    meta = {
+        'columns': list(gdf.columns),
+        'crs': gdf.crs.to_string(),
+    }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as op:
+        numpy.savez(
+            op,
+            wkb=numpy.frombuffer(b''.join(blobs), dtype=numpy.uint8),
+            ends=ends,
+            attributes=numpy.array(attributes.to_json(orient='table')),
+            meta=numpy.array(json.dumps(meta)),
+        )
+    os.replace(tmp_path, path)
+
+
+def load_geometry_cache(path):
+    with numpy.load(path) as cache:
+        wkb = cache['wkb'].tobytes()
+        ends = cache['ends']
+        attributes = pandas.read_json(str(cache['attributes']),
+                                      orient='table')
+        meta = json.loads(str(cache['meta']))
+
+    starts = numpy.concatenate([[0], ends[:-1]])
+    blobs = [wkb[start:end] for start, end in zip(starts, ends)]
+    if hasattr(shapely, 'from_wkb'):
+        geometry = shapely.from_wkb(blobs)
+    else:
+        geometry = [shapely.wkb.loads(blob) for blob in blobs]
+
+    gdf = gpd.GeoDataFrame(attributes, geometry=geometry, crs=meta['crs'])
+    return gdf[meta['columns']]
+
+
+# Levels of detail for the country map, as web mercator zoom levels,
+# coarsest first. Each level is simplified to half a pixel at its zoom
+# level. The coarsest is embedded in the page, and suits the map's
+# initial view; the others are loaded from COUNTRY_LOD_PATH when the
+# map is zoomed in far enough to need them.
+COUNTRY_LOD_ZOOMS = (4, 6, 8)
+COUNTRY_LOD_PATH = 'assets/data/country-lod'
 
-    print('len(protests_wrong_data)', len(protests_wrong_data))
-    print('protests_wrong_data.LAT.head()', protests_wrong_data.LAT.head())
-    print('protests_wrong_data.LONG.head()', protests_wrong_data.LONG.head())
+# The size of a unit of the country map's coordinates, in pixels at
+# the zoom level of each level of detail. Borders are drawn through the
+# centers of these units, so an eighth of a pixel is as good as exact.
+COUNTRY_QUANTUM_PIXELS = 1 / 8
 
-    protests = protests.drop(protests_wrong_data.index, axis='rows')
 
-    protests['LAT'] = protests.LAT.apply(float)
-    protests['LONG'] = protests.LONG.apply(float)
+def meters_per_pixel(zoom):
+    """The web mercator resolution of map tiles at `zoom`."""
+    return 2 * WEB_MERCATOR_EXTENT / (TILE_SIZE * 2 ** zoom)
 
-    print('len(set(protests[unique-key]))',
-          len(set(protests['unique-key'])))
-    print('len(protests)', len(protests))
-    assert len(set(protests['unique-key'])) == len(protests)
 
-    protests['perma'] = protests['unique-key'].apply(protest_name_perma)
-    protests = protests.set_index('unique-key')
+PROTESTS_PATH = 'data_to_map/data/protests.csv'
+COUNTRIES_PATH = 'data_to_map/data/countries.csv'
+
+# How each protest column is read. Columns that hold a few distinct
+# values, like the country and the (F[n]) filter columns, are
+# categorical; the coordinates are parsed as numbers after reading, so
+# that a malformed value rejects its row rather than the whole file.
+# Everything else is text.
+PROTEST_CATEGORY_COLUMNS = ['Country Name']
+PROTEST_NUMERIC_COLUMNS = ['LAT', 'LONG']
+PROTEST_KEY_COLUMN = 'unique-key'
+
+
+def is_filter_column(col):
+    return re.search(r'\s*[(]F[0-9]+[)]\s*', col) is not None
+
+
+def protest_dtypes(columns):
+    return {
+        col: ('category'
+              if col in PROTEST_CATEGORY_COLUMNS or is_filter_column(col)
+              else 'object')
+        for col in columns
+    }
+
+
+def csv_engine():
+    """
+    Use pyarrow's CSV parser if it's installed and pandas is new enough
+    (1.4) to use it, or pandas' own.
+    """
+    version = tuple(int(v) for v in pandas.__version__.split('.')[:2])
+    if version < (1, 4):
+        return 'c'
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return 'c'
+    return 'pyarrow'
+
+
+def load_protests(path=PROTESTS_PATH, engine=None):
+    """
+    Read the protest sheet, and return the protests that can be mapped,
+    as a GeoDataFrame in web mercator indexed by unique key, along with
+    a DataFrame reporting the rows that were rejected. The report gives
+    each rejected row's number in the sheet, its unique key, and the
+    reason it was rejected.
+    """
+    if engine is None:
+        engine = csv_engine()
+    columns = pandas.read_csv(path, nrows=0).columns
+    dtypes = protest_dtypes(columns)
+    protests = pandas.read_csv(path, dtype=dtypes, engine=engine)
+
+    # Rows are numbered as in the spreadsheet, where row 1 is the header.
+    # A quoted field can span several lines of the CSV file, so these
+    # aren't necessarily its line numbers.
+    protests.index = pandas.RangeIndex(2, len(protests) + 2, name='row')
+
+    for col in PROTEST_NUMERIC_COLUMNS:
+        protests[col] = pandas.to_numeric(protests[col], errors='coerce')
+
+    keys = protests[PROTEST_KEY_COLUMN]
+    reasons = [
+        ('missing coordinates', protests.LAT.isna() | protests.LONG.isna()),
+        ('coordinates out of range',
+         (protests.LAT.abs() > 90) | (protests.LONG.abs() > 180)),
+        ('missing unique key', keys.isna()),
+        ('duplicate unique key', keys.notna() & keys.duplicated()),
+    ]
+    rejected = pandas.Series(None, index=protests.index, dtype=object)
+    for reason, mask in reasons:
+        rejected = rejected.mask(mask & rejected.isna(), reason)
+    rejected = rejected.dropna()
+
+    report = pandas.DataFrame({
+        PROTEST_KEY_COLUMN: keys[rejected.index],
+        'reason': rejected,
+    })
+    if len(report):
+        print(f'Rejected {len(report)} of {len(protests)} protests:')
+        print(report.to_string())
+
+    protests = protests.drop(rejected.index, axis='rows')
+    protests['perma'] = protests[PROTEST_KEY_COLUMN].map(protest_name_perma)
+    protests = protests.set_index(PROTEST_KEY_COLUMN)
 
     protests = gpd.GeoDataFrame(
         protests,
@@ -198,7 +654,43 @@ def load_protests():
     )
     protests = protests.to_crs('EPSG:3857')  # CRS code for web mercator.
 
-    return protests
+    return protests, report
+
+
+# The protest columns displayed by the hover panel on the point map.
+# The detail columns can be loaded lazily,
+# in shards of DETAIL_SHARD_SIZE rows; see `Map.save_detail_shards`.
+POINT_DETAIL_COLUMNS = [
+    'School Name', 'Date', 'Locality Name', 'Description of Protest'
+]
+POINT_MAP_COLUMNS = ['perma', 'Event Type (F3)', 'Protest Location (F2)']
+POINT_HOVER_COLUMNS = POINT_DETAIL_COLUMNS + POINT_MAP_COLUMNS
+DETAIL_SHARD_SIZE = 128
+
+# Where the detail shards are written, relative to the jekyll site.
+DETAIL_SHARD_PATH = 'assets/data/protest-details'
+
+# The zoom levels at which the point map clusters protests on a grid,
+# coarsest first, and the width of a grid cell on screen, in pixels.
+# Zoomed in past the last level, protests are clustered only with those
+# at exactly the same location.
+CLUSTER_ZOOMS = (4, 5, 6, 7, 8)
+CLUSTER_CELL_PIXELS = 24
+
+# The vector tiles of protests written by `Map.save_vector_tiles`,
+# relative to the jekyll site. They are tiled at PROTEST_TILE_ZOOM
+# alone: there is nothing to simplify in a point, so coarser tiles
+# would just repeat them, and finer ones would split a view across
+# more downloads. The country map doesn't need tiles; it fetches its
+# finer levels of detail as a whole (see `Map.country_levels`).
+VECTOR_TILE_PATH = 'assets/tiles'
+PROTEST_TILE_ZOOM = 6
+
+# The protest columns listed on each country's page.
+COUNTRY_PAGE_PROTEST_COLUMNS = [
+    'Protest Name', 'Date', 'Locality Name', 'School Name',
+    'Description of Protest', 'Primary Source'
+]
 
 
 _name_errors = {
@@ -214,15 +706,101 @@ _name_errors = {
 }
 
 
-def sum_protests(protests, countries):
-    counts = defaultdict(int)
+def clean_country_names(protests):
+    """Return the protests' country names, with known errors fixed."""
+    names = protests['Country Name'].astype(object)
+    return names.map(lambda n: _name_errors.get(n, n))
 
-    names = [_name_errors[n] if n in _name_errors else n
-             for n in protests['Country Name']]
-    counts = Counter(names)
 
-    # print(set(counts) - set(countries['name']))
-    # print(set(countries['name']) - set(counts))
+def locate_protests(protests, countries):
+    """
+    Return the name of the country containing each protest, or NaN for
+    protests outside every country, as a Series aligned with
+    `protests`. The protests are located by their LAT and LONG columns,
+    and `countries` must be in web mercator. A protest on a shared
+    border goes to the first country that contains it.
+    """
+    x, y = lat_lon_to_web_mercator(protests.LONG.values, protests.LAT.values)
+    names = countries['name'].values
+    located = numpy.full(len(protests), -1, dtype=numpy.int64)
+
+    if hasattr(shapely, 'STRtree') and hasattr(shapely, 'points'):
+        # shapely 2: query every point against a tree of the countries
+        # in one call, and keep the first match for each.
+        tree = shapely.STRtree(numpy.asarray(countries.geometry))
+        point_ix, country_ix = tree.query(shapely.points(x, y),
+                                          predicate='intersects')
+        order = numpy.lexsort((country_ix, point_ix))
+        point_ix, country_ix = point_ix[order], country_ix[order]
+        first = numpy.r_[True, point_ix[1:] != point_ix[:-1]]
+        located[point_ix[first]] = country_ix[first]
+    else:
+        from shapely import vectorized
+
+        # Test each country against just the points inside its
+        # bounding box, most of which it will contain.
+        for i, geom in enumerate(countries.geometry):
+            minx, miny, maxx, maxy = geom.bounds
+            candidates = numpy.flatnonzero(
+                (located < 0) &
+                (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)
+            )
+            if len(candidates) == 0:
+                continue
+            inside = vectorized.contains(
+                geom, x[candidates], y[candidates]
+            )
+            located[candidates[inside]] = i
+
+    return pandas.Series(
+        numpy.where(located >= 0, names[located], numpy.nan),
+        index=protests.index, dtype=object
+    )
+
+
+# Where `protest_countries` saves its report, if there is anything to
+# report.
+MISMATCH_REPORT_PATH = 'data_to_map/.country-mismatches.csv'
+
+
+def protest_countries(protests, located, report_path=MISMATCH_REPORT_PATH):
+    """
+    Return the country to count each protest under: the one containing
+    it, if any, or else the one named in the sheet. Also return a
+    report of the protests whose coordinates lie in a different country
+    than the one named, which is saved as CSV to `report_path`, unless
+    it's None.
+    """
+    named = clean_country_names(protests)
+    mismatched = located.notna() & (located != named)
+    report = pandas.DataFrame({
+        'Country Name': named[mismatched],
+        'located in': located[mismatched],
+    })
+    if report_path is not None:
+        if len(report):
+            report.to_csv(report_path)
+        else:
+            try:
+                os.remove(report_path)
+            except FileNotFoundError:
+                pass
+    if len(report):
+        print(f'{len(report)} protests lie outside the country named '
+              f'in the sheet' +
+              (f'; see {report_path}' if report_path is not None else '.'))
+    return located.where(located.notna(), named), report
+
+
+def sum_protests(protests, countries, names=None):
+    """
+    Count the protests in each country, and rank the countries by their
+    counts. `names` gives the country of each protest; by default, it's
+    the country named in the sheet.
+    """
+    if names is None:
+        names = clean_country_names(protests)
+    counts = Counter(names)
 
     countries['protestcount'] = [counts[n] for n in countries['name']]
 
@@ -315,29 +893,237 @@ def individual_point_map(
     return plot
 
 
-def patches(plot, div, patch_data):
+TILE_SIZE = 256
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+
+# State for a process that exports protest PNGs. A worker exporting
+# through a browser creates one headless browser when it starts, and
+# reuses it for every image it exports, so we pay webdriver startup once
+# per worker rather than once per protest. A worker rendering static
+# images instead shares an on-disk tile cache with the other workers.
+_point_png_worker = {}
+
+
+def init_point_png_worker(protests, tile_url, tile_attribution,
+                          static=False):
+    _point_png_worker.update(
+        tile_url=tile_url,
+        tile_attribution=tile_attribution,
+        static=static,
+    )
+
+    if static:
+        _point_png_worker.update(
+            cache=thumbnails.TileCache(tile_url),
+            xs=protests.geometry.x.values,
+            ys=protests.geometry.y.values,
+        )
+        return
+
+    from bokeh.io.webdriver import webdriver_control
+
+    driver = webdriver_control.create()
+    # Pool workers skip atexit handlers, but they do run multiprocessing
+    # finalizers when the pool is closed normally.
+    multiprocessing.util.Finalize(driver, driver.quit, exitpriority=10)
+
+    _point_png_worker.update(
+        driver=driver,
+        point_source=GeoJSONDataSource(geojson=protests.to_json()),
+    )
+
+
+def export_point_png(task):
+    selected_ix, point_x, point_y, width, filename = task
+    start = time.perf_counter()
+
+    x_range = (point_x - width, point_x + width)
+    y_range = (point_y - width, point_y + width)
+    if _point_png_worker['static']:
+        image = thumbnails.static_point_map(
+            _point_png_worker['cache'],
+            _point_png_worker['xs'], _point_png_worker['ys'],
+            selected_ix, x_range, y_range,
+        )
+        image.save(filename)
+    else:
+        plot = individual_point_map(
+            _point_png_worker['point_source'], selected_ix,
+            x_range, y_range,
+            _point_png_worker['tile_url'],
+            _point_png_worker['tile_attribution'],
+        )
+        export_png(plot, filename=filename,
+                   webdriver=_point_png_worker['driver'])
+
+    return selected_ix, filename, time.perf_counter() - start
+
+
+def point_png_fingerprints(xs, ys, width, tile_url, renderer):
+    """
+    Return a digest for each protest's PNG that changes whenever the
+    image would. Apart from the tiles, an image depends only on the
+    protest's own coordinates and on those of the other protests
+    visible around it, so that is what we hash.
+    """
+    order = numpy.argsort(xs, kind='stable')
+    sorted_xs = xs[order]
+    lo = numpy.searchsorted(sorted_xs, xs - width, side='left')
+    hi = numpy.searchsorted(sorted_xs, xs + width, side='right')
+
+    fingerprints = []
+    for i in range(len(xs)):
+        near = numpy.sort(order[lo[i]:hi[i]])
+        near = near[numpy.abs(ys[near] - ys[i]) <= width]
+        sha = hashlib.sha256(
+            f'{renderer}|{tile_url}|{width}|'.encode('utf-8')
+        )
+        sha.update(numpy.array([xs[i], ys[i]]).tobytes())
+        sha.update(near.tobytes())
+        sha.update(xs[near].tobytes())
+        sha.update(ys[near].tobytes())
+        fingerprints.append(sha.hexdigest())
+    return fingerprints
+
+
+# Defines `decodeTopology`, which turns a topology from
+# `encode_topology` back into each country's rings, as the nested arrays
+# of xs and ys that MultiPolygons draws. Each topology is decoded once,
+# and kept until the map moves on to another.
+TOPOLOGY_JS = """
+        var decodeTopology = function(data) {
+            var cache = window.spaTopologies =
+                window.spaTopologies || new WeakMap();
+            if (cache.has(data)) {
+                return cache.get(data);
+            }
+            var coords = data.coords[0];
+            var arcLengths = data.arcs[0];
+            var shapes = data.shapes[0];
+            var offsets = data.offsets[0];
+            var quantum = data.quantum[0];
+
+            // Undo the delta encoding, arc by arc.
+            var arcXs = [], arcYs = [];
+            var x = 0, y = 0, k = 0;
+            for (const n of arcLengths) {
+                var ax = new Float64Array(n), ay = new Float64Array(n);
+                for (var i = 0; i < n; i++) {
+                    x += coords[k++];
+                    y += coords[k++];
+                    ax[i] = x * quantum;
+                    ay[i] = y * quantum;
+                }
+                arcXs.push(ax);
+                arcYs.push(ay);
+            }
+
+            // Join each ring's arcs, reversing those referred to as ~i,
+            // and dropping the point each arc shares with the one before.
+            var xs = [], ys = [];
+            for (var g = 0; g < offsets.length; g++) {
+                var p = offsets[g];
+                var geoXs = [], geoYs = [];
+                var npolys = shapes[p++];
+                for (var pi = 0; pi < npolys; pi++) {
+                    var polyXs = [], polyYs = [];
+                    var nrings = shapes[p++];
+                    for (var ri = 0; ri < nrings; ri++) {
+                        var narcs = shapes[p++];
+                        var length = 1;
+                        for (var j = 0; j < narcs; j++) {
+                            var ref = shapes[p + j];
+                            length += arcLengths[ref < 0 ? ~ref : ref] - 1;
+                        }
+                        var rx = new Float64Array(length);
+                        var ry = new Float64Array(length);
+                        var at = 0;
+                        for (var j = 0; j < narcs; j++) {
+                            var ref = shapes[p++];
+                            var a = ref < 0 ? ~ref : ref;
+                            var n = arcLengths[a];
+                            for (var i = j === 0 ? 0 : 1; i < n; i++) {
+                                var s = ref < 0 ? n - 1 - i : i;
+                                rx[at] = arcXs[a][s];
+                                ry[at] = arcYs[a][s];
+                                at++;
+                            }
+                        }
+                        polyXs.push(rx);
+                        polyYs.push(ry);
+                    }
+                    geoXs.push(polyXs);
+                    geoYs.push(polyYs);
+                }
+                xs.push(geoXs);
+                ys.push(geoYs);
+            }
+            var decoded = {xs: xs, ys: ys};
+            cache.set(data, decoded);
+            return decoded;
+        };
+"""
+
+# The country columns the country map uses: `rank` colors the patches,
+# the hover callback describes a country by its `name` and `protestcount`,
+# and clicking a country opens the page at `perma`.
+PATCH_COLUMNS = ['rank', 'name', 'protestcount', 'perma']
+
+
+def patches(plot, div, patch_data, levels):
+    """
+    Draw the countries in `patch_data` on `plot`, and describe the one
+    under the mouse in `div`.
+
+    The borders come from topologies made by `encode_topology`, with
+    their geometries in the same order as `patch_data`, at several
+    levels of detail; finer ones are swapped in as the map zooms in.
+    `levels` is a list of dicts, coarsest first, each holding the
+    `resolution` in meters per pixel at which that level becomes
+    detailed enough, and either a `source` holding its topology, or a
+    `url` to fetch it from. The page starts with the first level, which
+    must have a `source`.
+    """
+    # The patch source holds just an index into the topology for each
+    # country, which these transforms turn into its rings.
+    topology = levels[0]['source']
+    borders = {
+        axis: CustomJSTransform(
+            args=dict(topology=topology),
+            v_func=TOPOLOGY_JS + f"""
+        var decoded = decodeTopology(topology.data);
+        return Array.from(xs, function(i) {{ return decoded.{axis}[i]; }});
+"""
+        )
+        for axis in ['xs', 'ys']
+    }
+    shape = {axis: {'field': 'shape', 'transform': borders[axis]}
+             for axis in borders}
+
     color_mapper = LinearColorMapper(palette=palette)
     patches = MultiPolygons(
-        xs='xs', ys='ys',
+        xs=shape['xs'], ys=shape['ys'],
         fill_color={'field': 'rank', 'transform': color_mapper},
         fill_alpha=0.5, line_color="black", line_alpha=0.2,
         line_width=2.5
     )
     hover_patches = MultiPolygons(
-        xs='xs', ys='ys',
+        xs=shape['xs'], ys=shape['ys'],
         fill_color={'field': 'rank', 'transform': color_mapper},
         fill_alpha=0.5, line_color="black", line_alpha=0.5,
         line_width=3.5
     )
-    patch_source = geodf_patches_to_geods(patch_data)
+    patch_source = ColumnDataSource(data=dict(
+        {col: patch_data[col].values for col in PATCH_COLUMNS},
+        shape=numpy.arange(len(patch_data), dtype=numpy.int32),
+    ))
     render = plot.add_glyph(patch_source,
                             patches,
                             hover_glyph=hover_patches,
                             selection_glyph=patches,
                             nonselection_glyph=patches)
 
-    parsed_geojson = json.loads(patch_source.geojson)
-
     # str.source.selected.indices gives you a list of things that you
     # immediately clicked on
 
@@ -367,17 +1153,17 @@ def patches(plot, div, patch_data):
     #
 
     code = """
-var features = json_source['features'];
-var properties = features[cb_data.index.indices[0]];
-if (properties != undefined) {
-    var rank = properties['properties']['rank'] + 1;
-    var name = properties['properties']['name'];
-    var protestcount = properties['properties']['protestcount'];
+var data = source['data'];
+var index = cb_data.index.indices[0];
+if (index != undefined) {
+    var rank = data['rank'][index] + 1;
+    var name = data['name'][index];
+    var protestcount = data['protestcount'][index];
 }
 """
 
     callback = CustomJS(
-        args=dict(json_source=parsed_geojson, div=div),
+        args=dict(source=patch_source, div=div),
         code=code
     )
 
@@ -398,74 +1184,417 @@ if (properties != undefined) {
     )
     plot.add_tools(tap)
 
+    level_callback = CustomJS(
+        args=dict(
+            source=patch_source,
+            topology=topology,
+            x=plot.x_range,
+            width=plot.plot_width,
+            resolutions=[level['resolution'] for level in levels],
+            sources=[level.get('source') for level in levels],
+            urls=[level.get('url') for level in levels],
+        ),
+        code="""
+// Use the coarsest level that is still detailed enough for the
+// current zoom, or the finest there is.
+var resolution = (x.end - x.start) / width;
+var level = resolutions.length - 1;
+for (var i = 0; i < resolutions.length; i++) {
+    if (resolution >= resolutions[i]) {
+        level = i;
+        break;
+    }
+}
+
+// The topology of each level, or a promise of it while it loads.
+if (topology.spa_levels === undefined) {
+    topology.spa_levels = {0: topology.data};
+    topology.spa_level = 0;
+}
+if (level === topology.spa_level) {
+    return;
+}
+topology.spa_level = level;
+
+// Level files hold the topology's columns as Bokeh serializes them,
+// with the arrays base64 encoded.
+var arrayTypes = {int8: Int8Array, int16: Int16Array, int32: Int32Array,
+                  float32: Float32Array, float64: Float64Array};
+var decodeArrays = function(data) {
+    for (const col in data) {
+        data[col] = data[col].map(function(value) {
+            if (value === null || value.__ndarray__ === undefined) {
+                return value;
+            }
+            var bytes = atob(value.__ndarray__);
+            var buffer = new Uint8Array(bytes.length);
+            for (var i = 0; i < bytes.length; i++) {
+                buffer[i] = bytes.charCodeAt(i);
+            }
+            return new arrayTypes[value.dtype](buffer.buffer);
+        });
+    }
+    return data;
+};
+
+var levels = topology.spa_levels;
+if (!(level in levels)) {
+    if (sources[level] != null) {
+        levels[level] = sources[level].data;
+    } else {
+        levels[level] = fetch(urls[level]).then(function(response) {
+            return response.json();
+        }).then(decodeArrays);
+    }
+}
+Promise.resolve(levels[level]).then(function(data) {
+    levels[level] = data;
+    // Don't let a slow download replace a level chosen since.
+    if (topology.spa_level === level) {
+        topology.data = data;
+        source.change.emit();
+    }
+});
+"""
+    )
+    plot.x_range.js_on_change('start', level_callback)
+    plot.x_range.js_on_change('end', level_callback)
+
     return plot
 
 
-def points(plot, div, point_source):
-    point = Scatter(
-        marker="circle",
-        x='x', y='y', fill_color="purple", fill_alpha=0.5,
-        line_color="purple", line_alpha=0.5, size=6, name="points")
+# The number of protest cards the point map's side panel shows at once.
+PANEL_PAGE_SIZE = 20
+
+# Defines `renderPanel`, which fills the point map's side panel with
+# cards for the protests in `indices`, a page of `page_size` at a time.
+# `lookup(col, protest)` returns the value of a column for a given
+# protest. Cards are kept for reuse if `cache_cards` is true, unless
+# `options.ready(protest)` is false, meaning that the protest's data is
+# still loading. `options.show` is called with the protests on each
+# page before it is drawn.
+#
+# The hover callback calls `renderPanel` on every mouse move, so it only
+# notes the protests; the panel is drawn at most once per animation
+# frame, and only if they have changed. `refreshPanel` draws it again
+# regardless, for when more data has arrived.
+PROTEST_PANEL_JS = """
+        // The panel's state lives on the Div, so that it lasts from one
+        // call of the callback to the next.
+        var panel = div.spa_panel = div.spa_panel || {
+            indices: [], key: null, page: 0, pending: null, frame: null,
+            stale: false, cards: new Map()
+        };
+
+        var cardHtml = function(protest, lookup) {
+            var desc = lookup('Description of Protest', protest);
+            var uni = lookup('School Name', protest)
+                .toString()
+                .toUpperCase();
+            var type = lookup('Event Type (F3)', protest);
+            var date = lookup('Date', protest);
+            var locationName = lookup('Locality Name', protest);
+
+            // `baseurlPrefix` will need to match whatever
+            // baseurl Jekyll's _config.yml file specifies...
+            // pretty awkward, but I see no obvious alternative.
+            var baseurlPrefix = '/spa/'
+
+            var protestName = baseurlPrefix + lookup('perma', protest);
+
+            // In the following I tried to make the underlying HTML
+            // structure a little more visible. It's not perfect,
+            // but I hope it helps a bit.
+
+            var location = lookup('Protest Location (F2)', protest);
+
+            return '<a class ="spa-protest-result" target="_blank" href="' + protestName +'">'+'<section class="spa-category-button" style="background-color:white;argin:10px; padding-left:5px">'
+            + '<p style="padding:3px; display:inline-block; color:gray; font-size:15px">' +'<i class="fa fa-globe-africa" style="padding:3px">'+'</i>'+
+                    " " + uni + '</p>' + '<div style="font-weight: bold; padding:3px; display:inline-block; border-radius:4px">' + date +'</div>' + '<br  >'
+            + '<div style="padding-left:5px; padding-right:5px">' + desc + '</div>' + '<div style="background-color:#F7D9FA; padding:3px; display:inline-  block; border-radius:4px">' + type +'</div>'
+            + '<div style="background-color:#ccffff; padding:3px; display:inline-block; border-radius:4px">' + location +'</div>'
+                     + '<br>' + '</section>' + '</a>' + '<br>';
+        };
+
+        var pagerHtml = function(first, last, total) {
+            var button = function(step, label, enabled) {
+                return '<button type="button" ' +
+                       (enabled ? '' : 'disabled ') +
+                       'onclick="spaPanelPage(\\'' + div.id + '\\', ' +
+                       step + ')">' + label + '</button>';
+            };
+            return '<p class="spa-panel-pages">' +
+                   button(-1, '&lsaquo; Previous', first > 0) + ' ' +
+                   (first + 1) + '&ndash;' + last + ' of ' + total + ' ' +
+                   button(1, 'Next &rsaquo;', last < total) + '</p>';
+        };
+
+        var drawPanel = function() {
+            var total = panel.indices.length;
+            var first = panel.page * page_size;
+            var shown = panel.indices.slice(first, first + page_size);
+            panel.show(shown);
+
+            var parts = ["<div style='background-color:lightgray; " +
+                         "height:650px; padding:10px; overflow: scroll'>" +
+                         "<h3 style='color:gray'>" + "NUMBER OF PROTESTS: " +
+                         total + "</h3>"];
+            if (total > page_size) {
+                parts.push(pagerHtml(first, first + shown.length, total));
+            } else {
+                parts.push("<br>");
+            }
+            for (const protest of shown) {
+                var card = panel.cards.get(protest);
+                if (card === undefined) {
+                    card = cardHtml(protest, panel.lookup);
+                    if (cache_cards && panel.ready(protest)) {
+                        panel.cards.set(protest, card);
+                    }
+                }
+                parts.push(card);
+            }
+            parts.push("</div>");
 
-    hover_point = Scatter(
-        marker="star",
-        x='x', y='y', fill_color="purple", fill_alpha=0.8, line_width=5,
-        line_color="red", line_alpha=0.5, size=6, name="hover_points")
+            var text = parts.join('');
+            if (text !== div.text) {
+                div.text = text;
+            }
+        };
+
+        var schedulePanel = function() {
+            if (panel.frame !== null) {
+                return;
+            }
+            panel.frame = window.requestAnimationFrame(function() {
+                panel.frame = null;
+                var key = panel.pending.join(',');
+                if (key !== panel.key) {
+                    panel.key = key;
+                    panel.indices = panel.pending;
+                    panel.page = 0;
+                } else if (!panel.stale) {
+                    return;
+                }
+                panel.stale = false;
+                drawPanel();
+            });
+        };
+
+        var renderPanel = function(indices, lookup, options) {
+            options = options || {};
+            panel.pending = indices;
+            panel.lookup = lookup;
+            panel.ready = options.ready || (() => true);
+            panel.show = options.show || (() => {});
+            panel.draw = drawPanel;
+            schedulePanel();
+        };
+
+        var refreshPanel = function() {
+            panel.stale = true;
+            schedulePanel();
+        };
+
+        // The pager's buttons call this to turn the page.
+        window.spaPanels = window.spaPanels || {};
+        window.spaPanels[div.id] = panel;
+        window.spaPanelPage = window.spaPanelPage || function(id, step) {
+            var turned = window.spaPanels[id];
+            var pages = Math.ceil(turned.indices.length / page_size);
+            var page = Math.min(Math.max(turned.page + step, 0), pages - 1);
+            if (page !== turned.page) {
+                turned.page = page;
+                turned.draw();
+            }
+        };
+"""
+
+
+def points(plot, div, point_source, view=None, details=None,
+           clusters=None):
+    """
+    Draw the protests in `point_source` on `plot`, and describe the ones
+    under the mouse in `div`.
+
+    If `details` is given, the point source holds only what is needed
+    to draw and filter the points. The rest of the hover panel's data
+    is fetched on demand from the detail shards written by
+    `Map.save_detail_shards`; `details` is a dict holding their `url`,
+    the `shard_size`, and a `version` string that changes whenever
+    their content does.
+
+    If `clusters` is given, the protests that pass the filters in `view`
+    are drawn as clusters, at the level of clustering that suits the
+    zoom, instead of one by one. `clusters` is a dict holding the
+    `source` to draw them from, which starts out holding the coarsest
+    level's clusters of all the protests, and the `levels` from
+    `Map.point_clusters`, each as a ColumnDataSource of its cluster
+    centers, along with the `resolutions` at which they apply. Each
+    protest's cluster at level i is in the point source's `cluster_i`
+    column.
+    """
+    # Without a view, the filters refill `point_source` in place, so a
+    # protest's index can't identify its card for long.
+    hover_args = dict(source=point_source, div=div,
+                      page_size=PANEL_PAGE_SIZE,
+                      cache_cards=view is not None)
+    if view is None:
+        view = CDSView(source=point_source)
+
+    if clusters is None:
+        point = Scatter(
+            marker="circle",
+            x='x', y='y', fill_color="purple", fill_alpha=0.5,
+            line_color="purple", line_alpha=0.5, size=6, name="points")
+
+        hover_point = Scatter(
+            marker="star",
+            x='x', y='y', fill_color="purple", fill_alpha=0.8, line_width=5,
+            line_color="red", line_alpha=0.5, size=6, name="hover_points")
+
+        circle_renderer = plot.add_glyph(point_source,
+                                         point,
+                                         view=view,
+                                         hover_glyph=hover_point,
+                                         selection_glyph=point,
+                                         name="points")
+        hovered_js = HOVERED_POINTS_JS
+    else:
+        cluster_args = dict(clusters=clusters['source'],
+                            source=point_source,
+                            view=view,
+                            levels=clusters['levels'],
+                            resolutions=clusters['resolutions'],
+                            x=plot.x_range,
+                            width=plot.plot_width)
+
+        point = Scatter(
+            marker="circle",
+            x='x', y='y', fill_color="purple", fill_alpha=0.5,
+            line_color="purple", line_alpha=0.5, size='size',
+            name="points")
+
+        hover_point = Scatter(
+            marker="star",
+            x='x', y='y', fill_color="purple", fill_alpha=0.8, line_width=5,
+            line_color="red", line_alpha=0.5, size='size',
+            name="hover_points")
+
+        circle_renderer = plot.add_glyph(clusters['source'],
+                                         point,
+                                         hover_glyph=hover_point,
+                                         selection_glyph=point,
+                                         name="points")
+        plot.add_glyph(clusters['source'], Text(
+            x='x', y='y', text='label', text_align='center',
+            text_baseline='middle', text_font_size='9px',
+            text_color='white'
+        ))
+
+        # Redraw the clusters when the filters change, or when the map
+        # zooms far enough to need another level.
+        cluster_callback = CustomJS(args=cluster_args,
+                                    code=CLUSTER_JS + """
+
+        var level = clusterLevel();
+        if (cb_obj !== view && level === clusters.spa_level) {
+            return;
+        }
+        clusters.spa_level = level;
+
+        var members = clusterMembers(level);
+        var centers = levels[level].data;
+        var data = {x: [], y: [], count: [], size: [], label: [],
+                    cluster: []};
+        for (var c = 0; c + 1 < members.offsets.length; c++) {
+            var count = members.offsets[c + 1] - members.offsets[c];
+            if (count === 0) {
+                continue;
+            }
+            data.x.push(centers['x'][c]);
+            data.y.push(centers['y'][c]);
+            data.count.push(count);
+            data.size.push(clusterSize(count));
+            data.label.push(count > 1 ? String(count) : '');
+            data.cluster.push(c);
+        }
+        clusters.data = data;
+      """)
+        plot.x_range.js_on_change('start', cluster_callback)
+        plot.x_range.js_on_change('end', cluster_callback)
+        view.js_on_change('change', cluster_callback)
 
-    circle_renderer = plot.add_glyph(point_source,
-                                     point,
-                                     hover_glyph=hover_point,
-                                     selection_glyph=point,
-                                     name="points")
+        hover_args.update(cluster_args)
+        hovered_js = CLUSTER_JS + HOVERED_CLUSTERS_JS
 
-    hover_callback = CustomJS(args=dict(source=point_source, div=div),
-                              code="""
+    if details is None:
+        hover_callback = CustomJS(args=hover_args,
+                                  code=PROTEST_PANEL_JS + hovered_js + """
 
-        // `features` contains *all* the points that have been identified
-        // by the filters on the left side of the map.
+        // `features` contains the data for the points on the map. If the
+        // map filters its points through a view, this includes points
+        // hidden by the filters, but the hovered indices below always
+        // index into the full data, so we don't need to care.
         var features = source['data'];
 
-        // `indices` contains the indices of those points currently
-        // being hovered over on the map.
-        var indices = cb_data.index.indices;
+        if (indices.length != 0) {
+            renderPanel(indices, function(col, protest) {
+                return features[col][protest];
+            });
+        }
+      """)
+    else:
+        hover_args.update(details_url=details['url'],
+                          shard_size=details['shard_size'],
+                          version=details['version'])
+        hover_callback = CustomJS(args=hover_args,
+                                  code=PROTEST_PANEL_JS + hovered_js + """
+
+        var features = source['data'];
+
+        // Loaded shards of protest details, shared by all the maps on
+        // the page. A shard that is still loading is null.
+        var details = window.spaProtestDetails = window.spaProtestDetails ||
+                      {shards: {}};
 
+        var shardOf = function(protest) {
+            return Math.floor(protest / shard_size);
+        };
+
+        // Columns on the map come straight from the source; the rest come
+        // from the shards, or show an ellipsis until their shard arrives.
+        var lookup = function(col, protest) {
+            if (col in features) {
+                return features[col][protest];
+            }
+            var shard = details.shards[shardOf(protest)];
+            return shard ? shard[col][protest % shard_size] : '...';
+        };
+
+        var load = function(n) {
+            if (n in details.shards) {
+                return;
+            }
+            details.shards[n] = null;
+            fetch(details_url + '/' + n + '.json?v=' + version)
+                .then(response => response.json())
+                .then(shard => {
+                    details.shards[n] = shard;
+                    // Redraw the cards that were waiting for it.
+                    refreshPanel();
+                })
+                .catch(() => { delete details.shards[n]; });
+        };
+
+        // Only the shards of the protests on the page being shown are
+        // fetched.
         if (indices.length != 0) {
-            div.text = "<div style='background-color:lightgray; " +
-                       "height:650px; padding:10px; overflow: scroll'>" +
-                       "<h3 style='color:gray'>" + "NUMBER OF PROTESTS: " +
-                       indices.length + "</h3>" + "<br>"
-
-            for (var i = 0; i < indices.length; i++) {
-                var protest = indices[i];
-                var desc = features['Description of Protest'][protest];
-                var uni = features['School Name'][protest]
-                    .toString()
-                    .toUpperCase();
-                var type = features['Event Type (F3)'][protest];
-                var date = features['Date'][protest];
-                var locationName = features['Locality Name'][protest];
-
-                // `baseurlPrefix` will need to match whatever
-                // baseurl Jekyll's _config.yml file specifies...
-                // pretty awkward, but I see no obvious alternative.
-                var baseurlPrefix = '/spa/'
-
-                var protestName = baseurlPrefix + features['perma'][protest];
-
-                // In the following I tried to make the underlying HTML
-                // structure a little more visible. It's not perfect,
-                // but I hope it helps a bit.
-
-                var location = features['Protest Location (F2)'][protest];
-
-                div.text += '<a class ="spa-protest-result" target="_blank" href="' + protestName +'">'+'<section class="spa-category-button" style="background-color:white;argin:10px; padding-left:5px">'
-                + '<p style="padding:3px; display:inline-block; color:gray; font-size:15px">' +'<i class="fa fa-globe-africa" style="padding:3px">'+'</i>'+
-                        " " + uni + '</p>' + '<div style="font-weight: bold; padding:3px; display:inline-block; border-radius:4px">' + date +'</div>' + '<br  >'
-                + '<div style="padding-left:5px; padding-right:5px">' + desc + '</div>' + '<div style="background-color:#F7D9FA; padding:3px; display:inline-  block; border-radius:4px">' + type +'</div>'
-                + '<div style="background-color:#ccffff; padding:3px; display:inline-block; border-radius:4px">' + location +'</div>'
-                         + '<br>' + '</section>' + '</a>' + '<br>';
-                }
-          }
+            renderPanel(indices, lookup, {
+                ready: protest => Boolean(details.shards[shardOf(protest)]),
+                show: shown => shown.forEach(p => load(shardOf(p)))
+            });
+        }
       """)
 
     hover = HoverTool(
@@ -479,57 +1608,599 @@ def points(plot, div, point_source):
     plot.toolbar.active_inspect = hover
 
 
-def filter_values(protest_col):
-    # Some values are comma-separated lists. Drop null values, split lists,
-    # flatten them out, and deduplicate.
-    return set(val.strip()
-               for val_list in protest_col if not pandas.isnull(val_list)
-               for val in val_list.split(','))
-
+# Defines `indices`, the protests under the mouse on the point map.
+HOVERED_POINTS_JS = """
+        // `indices` contains the indices of those points currently
+        // being hovered over on the map.
+        var indices = cb_data.index.indices.slice();
+"""
 
-def toggle(filter_col, filter):
-    title = re.sub(r'\s*[(]F[0-9]+[)]\s*', '', filter_col)
-    class_select = title.replace(" ", "")
-    title = title.upper()
-    select_toggle = Toggle(
-        label=title+"  ",
-        width=175,
-        name=class_select,
-        active=True,
-        css_classes=[class_select, "bk-checkbox"]
-        )
+# Defines `indices` for a point map that draws clusters: the protests
+# in the clusters under the mouse that pass the filters.
+HOVERED_CLUSTERS_JS = """
+        var hoveredMembers = clusterMembers(clusterLevel());
+        var indices = [];
+        for (const hovered of cb_data.index.indices) {
+            var cluster = clusters.data['cluster'][hovered];
+            var first = hoveredMembers.offsets[cluster];
+            var last = hoveredMembers.offsets[cluster + 1];
+            for (var k = first; k < last; k++) {
+                indices.push(hoveredMembers.members[k]);
+            }
+        }
+"""
 
-    select_toggle.js_link('active', filter, 'visible')
+# Functions shared by the callbacks that draw clusters of protests and
+# describe them on hover; see `points`.
+CLUSTER_JS = """
+        // The coarsest level of clustering whose grid cells are still
+        // small enough on screen at the current zoom.
+        var clusterLevel = function() {
+            var resolution = (x.end - x.start) / width;
+            for (var i = 0; i < resolutions.length; i++) {
+                if (resolution >= resolutions[i]) {
+                    return i;
+                }
+            }
+            return resolutions.length - 1;
+        };
+
+        // The protests that pass the filters, sorted by their cluster at
+        // the given level, with the offset of each cluster's first one.
+        // Cached until the level or the filters change.
+        var clusterMembers = function(level) {
+            var cached = clusters.spa_members;
+            if (cached && cached.level === level &&
+                    cached.indices === view.indices) {
+                return cached;
+            }
+            var clusterOf = source.data['cluster_' + level];
+            var ncl = levels[level].data['x'].length;
+            var offsets = new Int32Array(ncl + 1);
+            for (const i of view.indices) {
+                offsets[clusterOf[i] + 1]++;
+            }
+            for (var c = 0; c < ncl; c++) {
+                offsets[c + 1] += offsets[c];
+            }
+            var next = offsets.slice(0, ncl);
+            var members = new Int32Array(view.indices.length);
+            for (const i of view.indices) {
+                members[next[clusterOf[i]]++] = i;
+            }
+            clusters.spa_members = {level: level, indices: view.indices,
+                                    offsets: offsets, members: members};
+            return clusters.spa_members;
+        };
+
+        // Marker size for a cluster of `count` protests; matches
+        // `cluster_size`.
+        var clusterSize = function(count) {
+            return Math.min(6 + 4 * Math.sqrt(count - 1), 30);
+        };
+"""
 
-    return select_toggle
 
+def cluster_size(count):
+    return numpy.minimum(6 + 4 * numpy.sqrt(count - 1), 30)
 
-def filter_name_camel(filter_name):
-    name = filter_name_clean(filter_name)
-    return name.replace(" ", "")
 
+def grid_clusters(x, y, cell=None):
+    """
+    Group the points with coordinates `x` and `y` by the square grid
+    cell, `cell` meters wide, that they fall in, or by their exact
+    location if `cell` is None. Returns the mean coordinates of each
+    cluster, and the cluster of each point, in the smallest unsigned
+    integer type that holds them.
+    """
+    keys = numpy.column_stack([x, y])
+    if cell is not None:
+        keys = numpy.floor(keys / cell)
+    _, cluster_of = numpy.unique(keys, axis=0, return_inverse=True)
+    cluster_of = cluster_of.ravel()
+    counts = numpy.bincount(cluster_of)
+    cluster_x = numpy.bincount(cluster_of, weights=x) / counts
+    cluster_y = numpy.bincount(cluster_of, weights=y) / counts
+    dtype = numpy.min_scalar_type(max(len(counts) - 1, 0))
+    return cluster_x, cluster_y, cluster_of.astype(dtype)
+
+
+# Functions for the filter callbacks of `Map.point_plot` that match
+# protests against the filters by their bitsets from `Map.filter_bitsets`.
+# The bitsets are base64 encoded, and decoded the first time they're used.
+BITSET_FILTER_JS = """
+            let decodeBitsets = function(bitsets, nwords) {
+                let cache = window.spaFilterBitsets =
+                    window.spaFilterBitsets || new WeakMap();
+                if (!cache.has(bitsets)) {
+                    let decoded = {};
+                    for (const [col, tags] of Object.entries(bitsets)) {
+                        decoded[col] = {};
+                        for (const [tag, b64] of Object.entries(tags)) {
+                            let bin = atob(b64);
+                            let bytes = new Uint8Array(nwords * 4);
+                            for (let i = 0; i < bin.length; i++) {
+                                bytes[i] = bin.charCodeAt(i);
+                            }
+                            decoded[col][tag] = new Uint32Array(bytes.buffer);
+                        }
+                    }
+                    cache.set(bitsets, decoded);
+                }
+                return cache.get(bitsets);
+            };
 
-def filter_name_clean(filter_name):
-    return re.sub(r'\s*[(]F[0-9]+[)]\s*', '', filter_name)
+            // Get the indices of the protests accepted by all filters.
+            // Start with every protest, and narrow down one filter at a
+            // time, ORing together the bitmaps of the selected tags of
+            // each, 32 protests at a time. A filter with no selections
+            // accepts everything.
+            let bitsetIndices = function(filters_state, bitsets, nrows) {
+                let nwords = Math.ceil(nrows / 32);
+                let bits = decodeBitsets(bitsets, nwords);
+                let accepted = new Uint32Array(nwords).fill(0xFFFFFFFF);
+                if (nrows % 32 !== 0) {
+                    accepted[nwords - 1] = (1 << (nrows % 32)) - 1;
+                }
+                for (const col of Object.keys(filters_state)) {
+                    if (!(col in bits)) { continue; }
+                    let selections = new Set(filters_state[col]);
+                    selections.delete('');
+                    if (selections.size === 0) { continue; }
+
+                    let any = new Uint32Array(nwords);
+                    for (const sel of selections) {
+                        let tagBits = bits[col][sel];
+                        if (tagBits === undefined) { continue; }
+                        for (let w = 0; w < nwords; w++) {
+                            any[w] |= tagBits[w];
+                        }
+                    }
+                    for (let w = 0; w < nwords; w++) {
+                        accepted[w] &= any[w];
+                    }
+                }
 
+                // Turn the set bits back into (ascending) indices.
+                let indices = [];
+                for (let w = 0; w < nwords; w++) {
+                    let word = accepted[w];
+                    while (word !== 0) {
+                        let low = word & -word;
+                        indices.push(w * 32 + 31 - Math.clz32(low));
+                        word ^= low;
+                    }
+                }
+                return indices;
+            };
+"""
 
-def one_filter(plot, filter_col, filter_vals, filters_state,
-               hidden_button, max_items):
-    # Remove (FX) from column name; probaby temporary
-    title = filter_name_camel(filter_col)
+# Functions for the filter callback of `Map.point_plot` when the
+# protests come from vector tiles, which hold each protest's tags as the
+# bitmasks of `TagColumn.masks`, in the columns named by
+# `Map.tag_mask_columns`.
+TAG_MASK_FILTER_JS = """
+            // The selected tags of each filter as a bitmask over its
+            // vocabulary, like the protests'. Filters with no selections
+            // accept everything, and are left out.
+            let selectionMasks = function(filters_state, vocabularies) {
+                let masks = {};
+                for (const [col, vocabulary] of Object.entries(vocabularies)) {
+                    let selections = new Set(filters_state[col]);
+                    selections.delete('');
+                    if (selections.size === 0) { continue; }
+                    let nwords = Math.ceil(vocabulary.length / 32);
+                    let mask = new Uint32Array(nwords);
+                    vocabulary.forEach(function(tag, code) {
+                        if (selections.has(tag)) {
+                            mask[code >> 5] |= 1 << (code & 31);
+                        }
+                    });
+                    masks[col] = mask;
+                }
+                return masks;
+            };
 
-    options = list(filter_vals)
-    multi_select = CheckboxGroup(
-        labels=options,
-        css_classes=[title, "bk-checkbox"],
-        default_size=150,
-        height_policy='min',
-        visible=True
-    )
+            // Get the indices of the protests in `data` that have one of
+            // the selected tags of every filter.
+            let maskIndices = function(masks, mask_columns, data, nrows) {
+                let filters = Object.entries(masks).map(([col, mask]) =>
+                    [mask, mask_columns[col].map(name => data[name])]
+                );
+                let indices = [];
+                for (let i = 0; i < nrows; i++) {
+                    let accept = true;
+                    for (const [mask, words] of filters) {
+                        let any = false;
+                        for (let w = 0; w < mask.length; w++) {
+                            if ((words[w][i] & mask[w]) !== 0) {
+                                any = true;
+                                break;
+                            }
+                        }
+                        if (!any) {
+                            accept = false;
+                            break;
+                        }
+                    }
+                    if (accept) {
+                        indices.push(i);
+                    }
+                }
+                return indices;
+            };
+"""
 
-    # The state of each multi-select is stored in an intermediate
-    # table; when a given multi-select is changed, the table is updated.
-    # The change to the table triggers a second update, defined below
+# Defines `decodeVectorTile`, which reads a Mapbox Vector Tile, like those
+# written by mvt.py, into a dict of its layers, each with its `extent`
+# and `features`. Each feature has its `type`, its `properties`, and its
+# `geometry` as a list of parts (points or rings), each a list of [x, y]
+# tile coordinates.
+VECTOR_TILE_JS = """
+            let decodeVectorTile = function(buffer) {
+                let bytes = new Uint8Array(buffer);
+                let view = new DataView(buffer);
+                let text = new TextDecoder();
+                let pos = 0;
+
+                let varint = function() {
+                    let value = 0, scale = 1, byte;
+                    do {
+                        byte = bytes[pos++];
+                        value += (byte & 0x7F) * scale;
+                        scale *= 128;
+                    } while (byte & 0x80);
+                    return value;
+                };
+                let zigzag = n => (n % 2 === 1 ? -(n + 1) / 2 : n / 2);
+
+                // The fields of the message between `start` and `end`, as
+                // [field, value] pairs. Varints and floats are read;
+                // anything length-delimited is left as its [start, end].
+                let readFields = function(start, end) {
+                    let fields = [];
+                    pos = start;
+                    while (pos < end) {
+                        let key = varint();
+                        let field = Math.floor(key / 8), wireType = key % 8;
+                        if (wireType === 0) {
+                            fields.push([field, varint()]);
+                        } else if (wireType === 1) {
+                            fields.push([field, view.getFloat64(pos, true)]);
+                            pos += 8;
+                        } else if (wireType === 2) {
+                            let length = varint();
+                            fields.push([field, [pos, pos + length]]);
+                            pos += length;
+                        } else if (wireType === 5) {
+                            fields.push([field, view.getFloat32(pos, true)]);
+                            pos += 4;
+                        } else {
+                            throw new Error('bad wire type ' + wireType);
+                        }
+                    }
+                    return fields;
+                };
+                let readPacked = function([start, end]) {
+                    let values = [];
+                    pos = start;
+                    while (pos < end) {
+                        values.push(varint());
+                    }
+                    return values;
+                };
+                let readString = function([start, end]) {
+                    return text.decode(bytes.subarray(start, end));
+                };
+                let readValue = function([start, end]) {
+                    let [[field, value]] = readFields(start, end);
+                    if (field === 1) { return readString(value); }
+                    if (field === 6) { return zigzag(value); }
+                    if (field === 7) { return value !== 0; }
+                    return value;
+                };
+                let readGeometry = function(commands) {
+                    let parts = [], part = null, x = 0, y = 0;
+                    let i = 0;
+                    while (i < commands.length) {
+                        let id = commands[i] & 7, count = commands[i] >> 3;
+                        i++;
+                        if (id === 7) {
+                            part.push(part[0]);
+                            continue;
+                        }
+                        for (let j = 0; j < count; j++) {
+                            x += zigzag(commands[i++]);
+                            y += zigzag(commands[i++]);
+                            if (id === 1) {
+                                part = [];
+                                parts.push(part);
+                            }
+                            part.push([x, y]);
+                        }
+                    }
+                    return parts;
+                };
+
+                let layers = {};
+                for (const [field, range] of readFields(0, bytes.length)) {
+                    if (field !== 3) { continue; }
+                    let name = '', extent = 4096;
+                    let keys = [], values = [], features = [];
+                    for (const [f, v] of readFields(range[0], range[1])) {
+                        if (f === 1) { name = readString(v); }
+                        else if (f === 2) { features.push(v); }
+                        else if (f === 3) { keys.push(readString(v)); }
+                        else if (f === 4) { values.push(v); }
+                        else if (f === 5) { extent = v; }
+                    }
+                    values = values.map(readValue);
+                    features = features.map(function([start, end]) {
+                        let feature = {type: 0, properties: {}, geometry: []};
+                        for (const [f, v] of readFields(start, end)) {
+                            if (f === 1) {
+                                feature.id = v;
+                            } else if (f === 2) {
+                                let tags = readPacked(v);
+                                for (let k = 0; k < tags.length; k += 2) {
+                                    feature.properties[keys[tags[k]]] =
+                                        values[tags[k + 1]];
+                                }
+                            } else if (f === 3) {
+                                feature.type = v;
+                            } else if (f === 4) {
+                                feature.geometry = readGeometry(readPacked(v));
+                            }
+                        }
+                        return feature;
+                    });
+                    layers[name] = {extent: extent, features: features};
+                }
+                return layers;
+            };
+"""
+
+# Loads the protest tiles in view that haven't been loaded yet, adds
+# their protests to full_source, and has the filters pick from them all
+# again; see `Map.point_plot`.
+PROTEST_TILES_JS = """
+            let size = 2 * extent / 2 ** zoom;
+            let last = 2 ** zoom - 1;
+            let clamp = t => Math.min(Math.max(Math.floor(t), 0), last);
+            let column = v => clamp((v + extent) / size);
+            let row = v => clamp((extent - v) / size);
+
+            if (full_source.spa_tiles === undefined) {
+                full_source.spa_available = new Set(tiles);
+                full_source.spa_tiles = new Set();
+            }
+            let requested = full_source.spa_tiles;
+
+            let downloads = [];
+            for (let tx = column(x.start); tx <= column(x.end); tx++) {
+                for (let ty = row(y.end); ty <= row(y.start); ty++) {
+                    let tile = zoom + '/' + tx + '/' + ty;
+                    if (!full_source.spa_available.has(tile) ||
+                            requested.has(tile)) {
+                        continue;
+                    }
+                    requested.add(tile);
+
+                    let left = tx * size - extent, top = extent - ty * size;
+                    downloads.push(fetch(url + '/' + tile + '.pbf')
+                    .then(function(response) {
+                        if (!response.ok) {
+                            throw new Error(response.statusText);
+                        }
+                        return response.arrayBuffer();
+                    }).then(function(buffer) {
+                        let layer = decodeVectorTile(buffer).protests;
+                        if (layer === undefined) { return; }
+                        let scale = size / layer.extent;
+                        let data = full_source.data;
+                        for (const feature of layer.features) {
+                            for (const [[px, py]] of feature.geometry) {
+                                for (const col of Object.keys(data)) {
+                                    let value = feature.properties[col];
+                                    if (col === 'x') {
+                                        value = left + px * scale;
+                                    } else if (col === 'y') {
+                                        value = top - py * scale;
+                                    } else if (value === undefined) {
+                                        value = '';
+                                    }
+                                    data[col].push(value);
+                                }
+                            }
+                        }
+                    }).catch(function(error) {
+                        // Try again the next time the map moves.
+                        requested.delete(tile);
+                        console.error('Protest tile ' + tile + ':', error);
+                    }));
+                }
+            }
+            if (downloads.length > 0) {
+                Promise.all(downloads).then(function() {
+                    filters_state.properties.data.change.emit();
+                });
+            }
+"""
+
+
+class TagColumn:
+    """
+    A filter column, parsed once. Some values are comma-separated lists
+    of tags, so each protest's tags are stored as codes into a shared
+    vocabulary of every tag in the column, sorted, in compressed sparse
+    row form: the tags of protest i are `codes[indptr[i]:indptr[i + 1]]`,
+    in the order the sheet lists them. Everything that needs the tags,
+    from the filter widgets to the protest pages, works from the codes,
+    so each tag's text is handled once, however many protests have it.
+    """
+
+    def __init__(self, vocabulary, codes, indptr):
+        self.vocabulary = vocabulary
+        self.codes = codes
+        self.indptr = indptr
+
+    @classmethod
+    def parse(cls, protest_col):
+        # Split each distinct value once, however many protests share
+        # it. Null values have no tags.
+        cells, values = pandas.factorize(protest_col)
+        cell_tags = [[tag.strip() for tag in str(value).split(',')]
+                     for value in values]
+        vocabulary = sorted({tag for tags in cell_tags for tag in tags})
+        index = {tag: i for i, tag in enumerate(vocabulary)}
+        cell_codes = numpy.array([index[tag] for tags in cell_tags
+                                  for tag in tags], dtype=numpy.int32)
+
+        # The same, per protest. The extra, empty cell at the end is the
+        # one that null values, with a cell of -1, pick out.
+        cell_lengths = numpy.array([len(tags) for tags in cell_tags] + [0])
+        cell_starts = numpy.cumsum(cell_lengths) - cell_lengths
+        lengths = cell_lengths[cells]
+        indptr = numpy.zeros(len(protest_col) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=indptr[1:])
+        positions = (numpy.repeat(cell_starts[cells] - indptr[:-1], lengths) +
+                     numpy.arange(indptr[-1]))
+        return cls(vocabulary, cell_codes[positions], indptr)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def rows(self):
+        """The protest each code belongs to."""
+        return numpy.repeat(numpy.arange(len(self)), numpy.diff(self.indptr))
+
+    def mask_words(self):
+        """The number of 32-bit words in each of `masks`."""
+        return max(1, -(-len(self.vocabulary) // 32))
+
+    def masks(self):
+        """
+        For each protest, a bitmask of its tags, as an array of
+        `mask_words()` 32-bit words per protest: bit c % 32 of word
+        c // 32 is set if the protest has the tag with code c.
+        """
+        masks = numpy.zeros((len(self), self.mask_words()),
+                            dtype=numpy.uint32)
+        bits = numpy.left_shift(numpy.uint32(1),
+                                (self.codes & 31).astype(numpy.uint32))
+        numpy.bitwise_or.at(masks, (self.rows(), self.codes >> 5), bits)
+        return masks
+
+    def counts(self):
+        """
+        The number of protests with each tag of the vocabulary. A protest
+        that lists a tag more than once counts once.
+        """
+        n_tags = len(self.vocabulary)
+        pairs = numpy.unique(self.rows() * n_tags + self.codes)
+        return numpy.bincount(pairs % n_tags, minlength=n_tags)
+
+    def bitsets(self):
+        """
+        For each tag, make a bitmap with one bit per protest, set if the
+        protest has that tag. Bit i of the bitmap is bit i % 32 of the
+        (i // 32)th little-endian 32-bit word, and each bitmap is base64
+        encoded, ready for a JS Uint32Array.
+        """
+        nbits = -(-len(self) // 32) * 32
+        rows = self.rows()
+
+        order = numpy.argsort(self.codes, kind='stable')
+        bounds = numpy.searchsorted(self.codes[order],
+                                    numpy.arange(len(self.vocabulary) + 1))
+
+        bitsets = {}
+        for i, tag in enumerate(self.vocabulary):
+            bits = numpy.zeros(nbits, dtype=bool)
+            bits[rows[order[bounds[i]:bounds[i + 1]]]] = True
+            words = numpy.packbits(bits, bitorder='little')
+            bitsets[tag] = base64.b64encode(words.tobytes()).decode('ascii')
+        return bitsets
+
+
+def toggle(filter_col, filter):
+    title = re.sub(r'\s*[(]F[0-9]+[)]\s*', '', filter_col)
+    class_select = title.replace(" ", "")
+    title = title.upper()
+    select_toggle = Toggle(
+        label=title+"  ",
+        width=175,
+        name=class_select,
+        active=True,
+        css_classes=[class_select, "bk-checkbox"]
+        )
+
+    select_toggle.js_link('active', filter, 'visible')
+
+    return select_toggle
+
+
+def filter_name_camel(filter_name):
+    name = filter_name_clean(filter_name)
+    return name.replace(" ", "")
+
+
+def filter_name_clean(filter_name):
+    return re.sub(r'\s*[(]F[0-9]+[)]\s*', '', filter_name)
+
+
+# Functions for the callbacks that restore a map's state from the URL
+# fragment when the page loads. The fragment is a comma-separated list
+# holding the four bounds of the visible region, or filter selections
+# like `Causes-Fee+increases`.
+HASH_STATE_JS = """
+            let hashParts = window.location.hash.slice(1).split(',');
+
+            // Move the ranges to the bounds in the fragment, if it has
+            // any, without announcing the change; that is left to
+            // `announceRanges`, so that it happens once, after any
+            // other state has been restored too.
+            let restoreRanges = function(x, y) {
+                let bounds = hashParts.map(v => +v);
+                if (bounds.length !== 4 || bounds.some(v => isNaN(v))) {
+                    return false;
+                }
+                let [xStart, xEnd, yStart, yEnd] = bounds;
+                if (x.start === xStart && x.end === xEnd &&
+                        y.start === yStart && y.end === yEnd) {
+                    return false;
+                }
+                y.setv({start: yStart, end: yEnd}, {silent: true});
+                x.setv({start: xStart, end: xEnd}, {silent: true});
+                return true;
+            };
+
+            // Redraw the plot, and run the x range's callbacks, which
+            // listen for changes to either end, just once.
+            let announceRanges = function(x, y) {
+                y.change.emit();
+                x.properties.end.change.emit();
+                x.change.emit();
+            };
+"""
+
+
+def one_filter(plot, filter_col, filter_vals, filters_state, max_items):
+    # Remove (FX) from column name; probaby temporary
+    title = filter_name_camel(filter_col)
+
+    options = list(filter_vals)
+    multi_select = CheckboxGroup(
+        labels=options,
+        css_classes=[title, "bk-checkbox"],
+        default_size=150,
+        height_policy='min',
+        visible=True
+    )
+
+    # The state of each multi-select is stored in an intermediate
+    # table; when a given multi-select is changed, the table is updated.
+    # The change to the table triggers a second update, defined below
     # in `point_plot`. That second update modifies the map based on
     # the state of all multi-selects simultaneously. This way, individual
     # multi-select widgets can operate independently without knowing
@@ -555,62 +2226,165 @@ def one_filter(plot, filter_col, filter_vals, filters_state,
         """)
     )
 
-    name = f'callback-load-hash-filter-{title}'
-    # print(name)
-    hidden_button.js_on_event(events.ButtonClick, CustomJS(
-        name=name,
-        args=dict(filter=multi_select, filterName=title),
-        code="""
-            let active = window.location.hash.slice(1).split(',')
-                .filter(a => a.startsWith(filterName))
-                .map(a => a.replace(filterName + '-', ''))
-                .map(a => a.replaceAll('+', ' '));
-
-            let activeMap = new Map();
-            for (let i = 0; i < filter.labels.length; i++) {
-                activeMap.set(filter.labels[i], i);
-            }
+    return multi_select
 
-            filter.active.splice(0);
-            for (const a of active) {
-                filter.active.push(activeMap.get(a));
-            }
 
-            // Force the widget to re-rennder. Otherwise
-            // the checkbox does not update.
-            filter.visible = false;
-            filter.visible = true;
+def front_matter(fields):
+    """
+    Return a jekyll front matter block holding `fields`. Each value is
+    written as JSON, which is also valid YAML, so that strings are
+    quoted and escaped correctly without a YAML library.
+    """
+    lines = [f'{key}: {json.dumps(value, ensure_ascii=False)}'
+             for key, value in fields.items()]
+    return '---\n' + '\n'.join(lines) + '\n---\n'
+
+
+def write_if_changed(path, text):
+    """
+    Write `text`, which may be bytes, to `path`, unless the file already
+    holds exactly that. Returns True if the file was written.
+    """
+    path = Path(path)
+    binary = isinstance(text, bytes)
+    try:
+        old = path.read_bytes() if binary else path.read_text(encoding='utf-8')
+        if old == text:
+            return False
+    except FileNotFoundError:
+        pass
+    if binary:
+        path.write_bytes(text)
+    else:
+        path.write_text(text, encoding='utf-8')
+    return True
+
+
+def country_level_files(levels):
+    """
+    Return the JSON text of the topology at each of the `levels` from
+    `Map.country_levels` but the first, keyed by zoom level. The text is
+    that of the topology's columns as Bokeh would serialize them, arrays
+    and all.
+    """
+    return {
+        zoom: serialize_json(transform_column_source_data(topology),
+                             pretty=False)
+        for zoom, topology in levels[1:]
+    }
+
+
+def country_levels_version(levels):
+    """
+    Return a version string for the files `country_level_files` makes
+    of `levels`, which changes with their content.
+    """
+    sha = hashlib.sha256()
+    for zoom, topology in levels[1:]:
+        sha.update(str(zoom).encode('utf-8'))
+        for name in sorted(topology):
+            column = numpy.asarray(topology[name])
+            sha.update(f'{name}:{column.dtype}:{column.shape}'.encode('utf-8'))
+            sha.update(column.tobytes())
+    return sha.hexdigest()[:16]
 
-            // Announce that the active filters have changed.
-            filter.properties.active.change.emit();
-        """)
-    )
-    return multi_select
+
+def save_country_levels(path, levels):
+    """
+    Write the topology at each of the `levels` from `Map.country_levels`
+    but the first to `path`, as `<zoom>.json`, leaving unchanged files
+    alone.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    files = country_level_files(levels)
+    for zoom, text in files.items():
+        write_if_changed(path / f'{zoom}.json', text)
+
+    for stale in path.glob('*.json'):
+        if stale.stem.isdigit() and int(stale.stem) not in files:
+            stale.unlink()
 
 
 class Map:
     def __init__(self):
-        self.protests = load_protests()
-        self.countries = load_geojson()
-        self.filters = self.collect_filters()
-        sum_protests(self.protests, self.countries)
+        # The borders at each set of levels of detail built so far; see
+        # `country_levels`.
+        self._country_levels = {}
+
+        with stage('load-protests'):
+            self.protests, self.rejected = load_protests()
+        with stage('load-geojson'):
+            self.countries = load_geojson()
+        with stage('collect-filters'):
+            self.filters = self.collect_filters()
+
+        # Count each protest under the country its coordinates lie in,
+        # and report those that disagree with the sheet.
+        with stage('locate-protests'):
+            located = locate_protests(self.protests, self.countries)
+            self.protest_countries, self.mismatched = protest_countries(
+                self.protests, located
+            )
+        with stage('sum-protests'):
+            sum_protests(self.protests, self.countries,
+                         self.protest_countries)
 
     def collect_filters(self):
         """
         Go through the protest CSV columns, identify the ones with an
-        (F[n]) annotation at the end, and return a list of just those column
-        names, sorted by the number n.
+        (F[n]) annotation at the end, and return a dict of just those
+        columns, sorted by the number n, each parsed into a `TagColumn`.
         """
 
         cols = self.protests.columns
-        filters = [f for f in cols if re.search(r'\s*[(]F[0-9]+[)]\s*', f)]
+        filters = [f for f in cols if is_filter_column(f)]
         digits = [int(re.search(r'\s*[(]F(?P<n>[0-9]+)[)]\s*', f)['n'])
                   for f in filters]
         filters = [f for d, f in sorted(zip(digits, filters))]
 
-        return {f: filter_values(self.protests[f]) for f in filters}
+        return {f: TagColumn.parse(self.protests[f]) for f in filters}
 
-    def patch_plot(self, tile_url, tile_attribution='MapTiler'):
+    def country_levels(self, zooms=COUNTRY_LOD_ZOOMS):
+        """
+        Return the country borders at each of the given zoom levels, as
+        a list of `(zoom, topology)` pairs, with each topology from
+        `encode_topology`, and its geometries in the same order as
+        `self.countries`.
+
+        The borders are broken into arcs just once, so that neighbors
+        share each border at every level. Each level's arcs are then
+        simplified to half a pixel, and rounded to an eighth of a pixel,
+        at its zoom level. The levels are built once for each set of
+        zooms, however many times they're asked for.
+        """
+        zooms = tuple(zooms)
+        if zooms in self._country_levels:
+            return self._country_levels[zooms]
+
+        quantum = meters_per_pixel(max(zooms)) * COUNTRY_QUANTUM_PIXELS
+        arcs, geometries = build_arcs(self.countries['geometry'].values,
+                                      quantum)
+        levels = []
+        for zoom in zooms:
+            resolution = meters_per_pixel(zoom)
+            scale = round(resolution * COUNTRY_QUANTUM_PIXELS / quantum)
+            level_arcs = simplify_arcs(arcs, resolution / 2 / quantum, scale)
+            levels.append((zoom, encode_topology(level_arcs, geometries,
+                                                 quantum * scale)))
+        self._country_levels[zooms] = levels
+        return levels
+
+    def patch_plot(self, tile_url, tile_attribution='MapTiler',
+                   levels_url=None, zooms=COUNTRY_LOD_ZOOMS):
+        """
+        Build the country map. The borders are drawn at several levels
+        of detail, chosen by how far the map is zoomed in. The coarsest
+        is embedded in the page. The others are embedded too, unless
+        `levels_url` is given, in which case they are fetched from the
+        files written there by `save_country_levels` when first needed.
+        """
         plot = base_map(tile_url, tile_attribution)
         div = Div(width=plot.plot_width // 2,
                   height=plot.plot_height,
@@ -624,19 +2398,28 @@ class Map:
             + '</div>'
             )
 
-        patches(plot, div, self.countries)
+        country_levels = self.country_levels(zooms)
+        if levels_url is not None:
+            version = country_levels_version(country_levels)
+
+        levels = []
+        for zoom, topology in country_levels:
+            level = {'resolution': meters_per_pixel(zoom)}
+            if not levels or levels_url is None:
+                level['source'] = ColumnDataSource(data=topology)
+            else:
+                level['url'] = f'{levels_url}/{zoom}.json?v={version}'
+            levels.append(level)
+
+        patches(plot, div, self.countries, levels)
 
         hash_callback = CustomJS(
-            name="callback-load-hash-coordinates-country",
+            name="callback-load-hash-state-country",
             args=dict(x=plot.x_range, y=plot.y_range),
-            code="""
-                console.log([x.start, x.end, y.start, y.end].join(','))
-                let data = window.location.hash.slice(1)
-                                 .split(',').map(x => +x);
-                if (data.length == 4 && data.every(x => !isNaN(x))) {
-                    [x.start, x.end, y.start, y.end] = data;
-                }
-                console.log(self);
+            code=HASH_STATE_JS + """
+            if (restoreRanges(x, y)) {
+                announceRanges(x, y);
+            }
             """
         )
         hidden_button = Button(label="Reset Zoom",
@@ -648,7 +2431,176 @@ class Map:
         button_layout = column(hidden_button, patches_layout)
         return button_layout
 
-    def point_plot(self, tile_url, tile_attribution='MapTiler'):
+    def compact_point_data(self, hover_columns=POINT_HOVER_COLUMNS):
+        """
+        Return the columns of protest data the point map needs: the
+        projected coordinates, and the given columns for the hover
+        panel. Everything else, like the sources, stays out of the page;
+        the filters use the bitsets from `filter_bitsets` instead of the
+        filter columns. The coordinates are single precision, which is
+        good to a few meters, and half the size.
+        """
+        data = {
+            'x': self.protests.geometry.x.values.astype(numpy.float32),
+            'y': self.protests.geometry.y.values.astype(numpy.float32),
+        }
+        for col in hover_columns:
+            data[col] = (self.protests[col].astype(object)
+                         .fillna('').astype(str).values)
+        return data
+
+    def point_clusters(self, zooms=CLUSTER_ZOOMS,
+                       cell_pixels=CLUSTER_CELL_PIXELS):
+        """
+        Cluster the protests on a grid for each of the given zoom levels,
+        and then by exact location. Returns a list of levels, coarsest
+        first, each a dict holding the `resolution`, in meters per pixel,
+        down to which it applies, the coordinates `x` and `y` of its
+        clusters, and `cluster_of`, the cluster of each protest.
+
+        Each grid is aligned with the web mercator origin and half the
+        width of the one before, so the clusters at each level nest
+        inside those of the level before.
+        """
+        x = self.protests.geometry.x.values
+        y = self.protests.geometry.y.values
+        levels = []
+        for zoom in zooms:
+            resolution = meters_per_pixel(zoom)
+            cluster_x, cluster_y, cluster_of = grid_clusters(
+                x, y, cell_pixels * resolution
+            )
+            levels.append(dict(resolution=resolution, x=cluster_x,
+                               y=cluster_y, cluster_of=cluster_of))
+        cluster_x, cluster_y, cluster_of = grid_clusters(x, y)
+        levels.append(dict(resolution=0, x=cluster_x, y=cluster_y,
+                           cluster_of=cluster_of))
+        return levels
+
+    def filter_bitsets(self):
+        """
+        Return a bitmap of the matching protests for each value of each
+        filter, as a dict of dicts keyed by filter column and then tag;
+        see `TagColumn.bitsets`.
+        """
+        return {col: tags.bitsets() for col, tags in self.filters.items()}
+
+    def detail_shards(self, shard_size=DETAIL_SHARD_SIZE):
+        """
+        Split the hover panel's detail columns into blocks of
+        `shard_size` rows. Returns a list of shards, each a dict of
+        columns, and a version string that changes with their content.
+        """
+        details = self.protests[POINT_DETAIL_COLUMNS].fillna('').astype(str)
+        shards = []
+        for start in range(0, len(details), shard_size):
+            block = details.iloc[start:start + shard_size]
+            shards.append({col: block[col].tolist() for col in block})
+
+        version = hashlib.sha256(
+            json.dumps(shards, sort_keys=True).encode('utf-8')
+        ).hexdigest()[:16]
+        return shards, version
+
+    def save_detail_shards(self, path, shard_size=DETAIL_SHARD_SIZE):
+        """
+        Write the detail shards to `path` as `0.json`, `1.json`, and so
+        on. Shards whose content hasn't changed are left alone, so that
+        jekyll doesn't see them as modified.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        shards, _ = self.detail_shards(shard_size)
+        for n, shard in enumerate(shards):
+            write_if_changed(path / f'{n}.json',
+                             json.dumps(shard, ensure_ascii=False))
+
+        # Remove shards left over from a longer protest list.
+        for stale in path.glob('*.json'):
+            if stale.stem.isdigit() and int(stale.stem) >= len(shards):
+                stale.unlink()
+
+    def tag_mask_columns(self):
+        """The names of the columns of each filter's `TagColumn.masks`,
+        one per 32-bit word, as the vector tiles hold them."""
+        return {col: [f'{col} #{w}' for w in range(tags.mask_words())]
+                for col, tags in self.filters.items()}
+
+    def protest_tile_columns(self):
+        """The protest columns in the vector tiles: those the hover panel
+        shows, and the bitmasks of tags that the filters match."""
+        return POINT_HOVER_COLUMNS + [
+            name for names in self.tag_mask_columns().values()
+            for name in names
+        ]
+
+    def protest_tiles(self, zoom=PROTEST_TILE_ZOOM):
+        """The `(z, x, y)` of each vector tile that holds protests."""
+        tx, ty = mvt.tile_of(self.protests.geometry.x.values,
+                             self.protests.geometry.y.values, zoom)
+        return sorted({(zoom, x, y) for x, y in zip(tx.tolist(), ty.tolist())})
+
+    def vector_tiles(self, zoom=PROTEST_TILE_ZOOM):
+        """
+        Return the protest map's vector tiles, encoded, keyed by
+        `(z, x, y)`. Each has a `protests` layer, with the protests in
+        the tile at `zoom` and the columns from `protest_tile_columns`.
+        Tiles with no protests in them are left out.
+        """
+        properties = (self.protests[POINT_HOVER_COLUMNS]
+                      .astype(object).fillna('').astype(str))
+        for col, names in self.tag_mask_columns().items():
+            masks = self.filters[col].masks()
+            for w, name in enumerate(names):
+                properties[name] = masks[:, w].tolist()
+        properties = properties.to_dict(orient='records')
+        tiles = mvt.point_features(self.protests.geometry.x.values,
+                                   self.protests.geometry.y.values,
+                                   properties, zoom)
+        return {tile: mvt.encode_tile({'protests': features})
+                for tile, features in tiles.items()}
+
+    def save_vector_tiles(self, path, **options):
+        """
+        Write the vector tiles from `vector_tiles` to `path`, as
+        `<z>/<x>/<y>.pbf`, leaving unchanged files alone, and removing
+        tiles that are no longer made.
+        """
+        path = Path(path)
+        tiles = self.vector_tiles(**options)
+        for (z, x, y), tile in tiles.items():
+            tile_path = path / str(z) / str(x) / f'{y}.pbf'
+            tile_path.parent.mkdir(parents=True, exist_ok=True)
+            write_if_changed(tile_path, tile)
+
+        for stale in path.glob('*/*/*.pbf'):
+            tile = stale.parent.parent.name, stale.parent.name, stale.stem
+            if (all(part.isdigit() for part in tile) and
+                    tuple(int(part) for part in tile) not in tiles):
+                stale.unlink()
+
+    def point_plot(self, tile_url, tile_attribution='MapTiler',
+                   compact=True, details_url=None, tiles_url=None):
+        """
+        Build the protest map, with its filters and hover panel.
+
+        If `compact` is true, the page carries a single copy of just the
+        protest columns the map uses, and the filters choose which points
+        to draw through a CDSView. Otherwise, it carries two copies of
+        the full protest data, and the filters copy the selected rows
+        from one to the other.
+
+        If `details_url` is given (compact mode only), the hover panel's
+        longer fields are left out of the page, and fetched from the
+        detail shards at that URL when they are first needed.
+
+        If `tiles_url` is given, the page carries no protests at all.
+        They are loaded from the vector tiles written there by
+        `save_vector_tiles`, a tile at a time, as the map shows each
+        part of Africa, and the filters copy the selected rows of those
+        loaded so far, as they do without `compact`.
+        """
         plot = base_map(tile_url, tile_attribution)
 
         div = Div(width=plot.plot_width // 2,
@@ -658,107 +2610,118 @@ class Map:
                        "<h3 style='color:gray'>" + "Use filters to the left to display protests based on category. Hover over protests on map for more information." +
                         "</h3>" + "<br>")
 
-        # Create two copies of the protest data. One will be the data to be
-        # displayed, and will be mutable. The other will be an unchanging
-        # collection of all the data. Upon a filter change, the data to
-        # be displayed is emptied and filled with a subset of the full data.
-        protests_json = self.protests.to_json()
-        full_source = GeoJSONDataSource(geojson=protests_json)
-        point_source = GeoJSONDataSource(geojson=protests_json)
-
-        # Here, point_source, which contains just the selected points,
-        # gets "attached" to the map and the hover div.
-        points(plot, div, point_source)
+        if compact and tiles_url is None:
+            # A single, unchanging copy of the data. The view holds the
+            # indices of the points that pass the filters; the renderer
+            # draws just those.
+            #
+            # We set the view's indices by hand rather than through an
+            # IndexFilter, because BokehJS intersects filter results with
+            # an algorithm that is quadratic in the number of points.
+            if details_url is None:
+                details = None
+                point_data = self.compact_point_data()
+            else:
+                _, version = self.detail_shards()
+                details = dict(url=details_url,
+                               shard_size=DETAIL_SHARD_SIZE,
+                               version=version)
+                point_data = self.compact_point_data(POINT_MAP_COLUMNS)
+
+            # The protests are drawn in clusters, which are redrawn
+            # when the filters change or the map zooms to another level
+            # of clustering. The page starts out with the coarsest
+            # level's clusters of all the protests.
+            levels = self.point_clusters()
+            for i, level in enumerate(levels):
+                point_data[f'cluster_{i}'] = level['cluster_of']
+            counts = numpy.bincount(levels[0]['cluster_of'])
+            clusters = dict(
+                source=ColumnDataSource(data={
+                    'x': levels[0]['x'].astype(numpy.float32),
+                    'y': levels[0]['y'].astype(numpy.float32),
+                    'count': counts,
+                    'size': cluster_size(counts),
+                    'label': [str(c) if c > 1 else '' for c in counts],
+                    'cluster': numpy.arange(len(counts)),
+                }),
+                levels=[ColumnDataSource(data={
+                    'x': level['x'].astype(numpy.float32),
+                    'y': level['y'].astype(numpy.float32),
+                }) for level in levels],
+                resolutions=[level['resolution'] for level in levels],
+            )
 
-        hash_callback = CustomJS(
-            name="callback-load-hash-coordinates-protests",
-            args=dict(x=plot.x_range, y=plot.y_range),
-            code="""
-                console.log([x.start, x.end, y.start, y.end].join(','))
-                let data = window.location.hash.slice(1)
-                                 .split(',').map(x => +x);
-                if (data.length == 4 && data.every(x => !isNaN(x))) {
-                    [x.start, x.end, y.start, y.end] = data;
-                }
+            point_source = ColumnDataSource(data=point_data)
+            view = CDSView(source=point_source)
+            points(plot, div, point_source, view, details, clusters)
+
+            # Each filter value comes with a precomputed bitmap of the
+            # protests it matches. The callback ORs together the bitmaps
+            # of the selected values within each filter, and ANDs the
+            # results across filters, 32 protests at a time.
+            filter_callback = CustomJS(
+                args=dict(view=view,
+                          bitsets=self.filter_bitsets(),
+                          nrows=len(self.protests)),
+                code=BITSET_FILTER_JS + """
+            let indices = bitsetIndices(cb_obj.data, bitsets, nrows);
+            view.setv({indices: indices}, {silent: true});
+            view.indices_map_to_subset();
+            view.change.emit();
+            """)
+        else:
+            # Create two copies of the protest data. One will be the data
+            # to be displayed, and will be mutable. The other will be an
+            # unchanging collection of all the data. Upon a filter change,
+            # the data to be displayed is emptied and filled with a subset
+            # of the full data.
+            #
+            # With every protest embedded, in order, the protests are
+            # matched as in the compact map, by their filter bitsets. The
+            # tiles hold each protest's tags as bitmasks instead.
+            if tiles_url is None:
+                protests_json = self.protests.to_json()
+                full_source = GeoJSONDataSource(geojson=protests_json)
+                point_source = GeoJSONDataSource(geojson=protests_json)
+                match_args = dict(bitsets=self.filter_bitsets(),
+                                  nrows=len(self.protests))
+                match_js = BITSET_FILTER_JS
+                indices_js = """
+            let indices = bitsetIndices(filters_state, bitsets, nrows);
+            """
+            else:
+                # Both start out empty, and the tiles fill in full_source.
+                columns = ['x', 'y'] + self.protest_tile_columns()
+                full_source = ColumnDataSource(
+                    data={col: [] for col in columns}
+                )
+                point_source = ColumnDataSource(
+                    data={col: [] for col in columns}
+                )
+                match_args = dict(
+                    vocabularies={col: tags.vocabulary
+                                  for col, tags in self.filters.items()},
+                    mask_columns=self.tag_mask_columns(),
+                )
+                match_js = TAG_MASK_FILTER_JS
+                indices_js = """
+            let indices = maskIndices(
+                selectionMasks(filters_state, vocabularies), mask_columns,
+                full_source.data, full_source.data['x'].length
+            );
             """
-        )
-        hidden_button = Button(label="Reset Zoom",
-                               button_type="success",
-                               visible=False)
-        hidden_button.js_on_event(events.ButtonClick, hash_callback)
 
-        # The number of items is different for different filters, but
-        # they are stored in a table that must have the same number of
-        # items in each column, so we pad the columns with empty strings.
-        max_items = max(len(v) for v in self.filters.values())
+            # Here, point_source, which contains just the selected points,
+            # gets "attached" to the map and the hover div.
+            points(plot, div, point_source)
 
-        # The filters will modify the points displayed on the map, but
-        # they will do so indirectly. They will modify the content of
-        # filters_state via their callbacks. *Then*, whenever filters_state
-        # is changed, it will modify the point_source based on its knowledge
-        # of the current state of all the filters at once. This way,
-        # the filters don't have to pay any attention to each other; their
-        # interaction is managed entirely by the filters_state object, via
-        # this callback.
-        filters_state = ColumnDataSource(pandas.DataFrame({
-            col: [''] * max_items for col in self.filters
-        }))
-        filters_state.js_on_change('data', CustomJS(
-            args=dict(point_source=point_source,
-                      full_source=full_source),
-            code="""
+            filter_callback = CustomJS(
+                args=dict(point_source=point_source,
+                          full_source=full_source, **match_args),
+                code=match_js + """
             let filters_state = cb_obj.data;
 
-            // A given protest can have multiple tags separated by commas.
-            let unpackVals = function(vals) {
-                vals = vals ? vals.split(',').map(s => s.trim()) : [];
-                return new Set(vals);
-            };
-
-            // Do any of the selected tags match any of the protest tags?
-            let selectionMatch = function(selections, vals) {
-                vals = unpackVals(vals);
-                selections = new Set(selections);
-                selections.delete('');
-
-                // If no selections have been made, it's a match.
-                if (selections.size === 0) {
-                    return true;
-                }
-
-                // If there is any intersection, it's a match.
-                for (const sel of selections) {
-                    if (vals.has(sel)) {
-                        return true;
-                    }
-                }
-                return false;
-            };
-
-            // Get the indices of the protests accepted by all filters.
-            let filterIndices = function(filters_state, full_source) {
-                let cols = Object.keys(filters_state);
-                let nrows = full_source.data[cols[0]].length;
-                let indices = [];
-
-                for (let i = 0; i < nrows; i++) {
-                    let accept = true;
-                    for (const col of cols) {
-                        if (col === 'index') { continue; }
-                        let selections = filters_state[col];
-                        let vals = full_source.data[col][i];
-                        if (!selectionMatch(selections, vals)) {
-                            accept = false;
-                            break;
-                        }
-                    }
-                    if (accept) {
-                        indices.push(i);
-                    }
-                }
-                return indices;
-            };
-
             // Empty out the point_source data.
             for (const [column, values] of Object.entries(point_source.data)) {
                 while (values.length > 0) {
@@ -767,7 +2730,7 @@ class Map:
             }
 
             // Refill the point_source data based on the current filter state.
-            let indices = filterIndices(filters_state, full_source);
+            """ + indices_js + """
             for (const [column, values] of Object.entries(full_source.data)) {
                 for (const i of indices) {
                     point_source.data[column].push(values[i]);
@@ -775,105 +2738,371 @@ class Map:
             }
 
             point_source.change.emit();
-            """))
+            """)
+
+        # The number of items is different for different filters, but
+        # they are stored in a table that must have the same number of
+        # items in each column, so we pad the columns with empty strings.
+        max_items = max(len(tags.vocabulary)
+                        for tags in self.filters.values())
+
+        # The filters will modify the points displayed on the map, but
+        # they will do so indirectly. They will modify the content of
+        # filters_state via their callbacks. *Then*, whenever filters_state
+        # is changed, it will modify the points displayed based on its
+        # knowledge of the current state of all the filters at once. This
+        # way, the filters don't have to pay any attention to each other;
+        # their interaction is managed entirely by the filters_state
+        # object, via this callback.
+        filters_state = ColumnDataSource(pandas.DataFrame({
+            col: [''] * max_items for col in self.filters
+        }))
+        filters_state.js_on_change('data', filter_callback)
+
+        if tiles_url is not None:
+            tiles_callback = CustomJS(
+                name="callback-load-protest-tiles",
+                args=dict(x=plot.x_range, y=plot.y_range,
+                          full_source=full_source,
+                          filters_state=filters_state,
+                          url=tiles_url,
+                          zoom=PROTEST_TILE_ZOOM,
+                          tiles=['{}/{}/{}'.format(*tile)
+                                 for tile in self.protest_tiles()],
+                          extent=WEB_MERCATOR_EXTENT),
+                code=VECTOR_TILE_JS + PROTEST_TILES_JS
+            )
+            plot.x_range.js_on_change('start', tiles_callback)
+            plot.x_range.js_on_change('end', tiles_callback)
+            plot.y_range.js_on_change('start', tiles_callback)
+            plot.y_range.js_on_change('end', tiles_callback)
 
         duo_stack = []
-        for filter_name, filter_vals in self.filters.items():
-            filter = one_filter(plot, filter_name, filter_vals,
-                                filters_state, hidden_button, max_items)
+        widgets = {}
+        for filter_name, tags in self.filters.items():
+            filter = one_filter(plot, filter_name, tags.vocabulary,
+                                filters_state, max_items)
+            widgets[filter_name] = filter
             tog = toggle(filter_name, filter)
             duo_stack.append(tog)
             duo_stack.append(filter)
         duo_col = column(*duo_stack)
         duo_col.css_classes = ["spa-filters-column"]
 
+        # Restore the view and every filter from the URL fragment in one
+        # go. The checkboxes are set silently, so that rather than each
+        # widget updating filters_state in turn, filters_state changes
+        # once, and the protests are filtered once.
+        hash_callback = CustomJS(
+            name="callback-load-hash-state-protests",
+            args=dict(x=plot.x_range, y=plot.y_range,
+                      filters={filter_name_camel(col): widget
+                               for col, widget in widgets.items()},
+                      columns={filter_name_camel(col): col
+                               for col in widgets},
+                      filters_state=filters_state),
+            code=HASH_STATE_JS + """
+            let moved = restoreRanges(x, y);
+
+            let changed = false;
+            for (const [name, filter] of Object.entries(filters)) {
+                let selected = new Set(
+                    hashParts.filter(a => a.startsWith(name + '-'))
+                        .map(a => a.slice(name.length + 1))
+                        .map(a => a.replaceAll('+', ' '))
+                );
+                let active = [];
+                for (let i = 0; i < filter.labels.length; i++) {
+                    if (selected.has(filter.labels[i])) {
+                        active.push(i);
+                    }
+                }
+                if (active.join() === filter.active.join()) {
+                    continue;
+                }
+                changed = true;
+
+                // Update the checkboxes without running the widget's own
+                // callback, and fill in its column of filters_state.
+                filter.setv({active: active}, {silent: true});
+                filter.change.emit();
+
+                let state_col = filters_state.data[columns[name]];
+                for (let i = 0; i < state_col.length; i++) {
+                    state_col[i] = i < active.length ?
+                        filter.labels[active[i]] : '';
+                }
+            }
+
+            if (changed) {
+                filters_state.properties.data.change.emit();
+            }
+            if (moved) {
+                announceRanges(x, y);
+            }
+            """
+        )
+        hidden_button = Button(label="Reset Zoom",
+                               button_type="success",
+                               visible=False)
+        hidden_button.js_on_event(events.ButtonClick, hash_callback)
+
         map_select = row(duo_col, plot, div)
         layout = column(hidden_button, map_select)
         return layout
 
     def individual_point_plots(
-            self, tile_url, tile_attribution='MapTiler'
+            self, tile_url, tile_attribution='MapTiler',
+            path='docs/assets/img/protest-points', workers=None,
+            force=False, state_path='data_to_map/.point-png-state.json',
+            static=True
             ):
+        """
+        Export a PNG thumbnail of each protest's location.
+
+        By default, thumbnails are drawn directly from cached map tiles
+        by `thumbnails.static_point_map`. It draws the markers as Bokeh
+        does, but not the tile attribution, so its thumbnails look a
+        little different from Bokeh's. If `static` is false, each is
+        instead rendered by Bokeh in a headless browser, as on the site,
+        and as every thumbnail was before the tile cache. The export
+        state records which renderer drew each thumbnail, so switching
+        renderers re-exports them all. The work is spread across
+        `workers` processes (by default, one per CPU);
+        in browser mode, each holds its own long-lived browser.
+
+        Protests whose PNG already exists and whose surroundings haven't
+        changed since it was exported are skipped, unless `force` is
+        true.
+        """
+        width = 5000
+        xs = self.protests.geometry.x.values
+        ys = self.protests.geometry.y.values
+        renderer = 'static' if static else 'bokeh'
+        fingerprints = point_png_fingerprints(xs, ys, width, tile_url,
+                                              renderer)
+
+        state_path = Path(state_path)
+        try:
+            with open(state_path, encoding='utf-8') as ip:
+                exported = json.load(ip)
+        except (OSError, ValueError):
+            exported = {}
+
+        tasks = []
+        for selected_ix, fingerprint in enumerate(fingerprints):
+            filename = f'{path}/protest_{selected_ix}.png'
+            if (not force and Path(filename).exists() and
+                    exported.get(filename) == fingerprint):
+                continue
+            tasks.append((selected_ix, xs[selected_ix], ys[selected_ix],
+                          width, filename))
+
+        print(f'Exporting {len(tasks)} of {len(fingerprints)} protest PNGs; '
+              f'{len(fingerprints) - len(tasks)} are up to date.')
+        if not tasks:
+            return
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(tasks)))
+
+        initargs = (self.protests, tile_url, tile_attribution, static)
+        if workers == 1:
+            init_point_png_worker(*initargs)
+            results = map(export_point_png, tasks)
+        else:
+            pool = multiprocessing.Pool(workers,
+                                        initializer=init_point_png_worker,
+                                        initargs=initargs)
+            results = pool.imap_unordered(export_point_png, tasks)
 
-        protests_json = self.protests.to_json()
-        point_source = GeoJSONDataSource(geojson=protests_json)
-
-        for selected_ix in range(len(self.protests)):
-            geo = self.protests.iloc[selected_ix].geometry.coords[0]
-            point_x, point_y = geo
-
-            width = 5000
-            x_range = (point_x - width, point_x + width)
-            y_range = (point_y - width, point_y + width)
-
-            plot = individual_point_map(
-                point_source, selected_ix,
-                x_range, y_range,
-                tile_url, tile_attribution
-                )
-            path = 'docs/assets/img/protest-points'
-            export_png(plot, filename=f'{path}/protest_{selected_ix}.png')
+        start = time.perf_counter()
+        try:
+            for done, (selected_ix, filename, seconds) in enumerate(results):
+                exported[filename] = fingerprints[selected_ix]
+                print(f'[{done + 1}/{len(tasks)}] {filename} '
+                      f'({seconds:.2f}s)')
+
+                # Save progress as we go, so that an interrupted export
+                # picks up where it left off.
+                if done % 50 == 49 or done + 1 == len(tasks):
+                    with open(state_path, 'w', encoding='utf-8') as op:
+                        json.dump(exported, op, indent=0, sort_keys=True)
+        finally:
+            if workers > 1:
+                pool.close()
+                pool.join()
+            elif not static:
+                _point_png_worker['driver'].quit()
+
+        # The cache may hold tiles from earlier static exports even when
+        # this one rendered through a browser.
+        thumbnails.TileCache(tile_url).evict()
+
+        elapsed = time.perf_counter() - start
+        print(f'Exported {len(tasks)} PNGs in {elapsed:.1f}s '
+              f'with {workers} workers '
+              f'({elapsed / len(tasks):.2f}s per image).')
 
     def country_pages(self, path):
-        for i, name in enumerate(sorted(self.countries.index.values)):
+        """
+        Write a page for each country. Its front matter holds the
+        country's record from countries.csv and the list of its
+        protests, so the layout doesn't have to search the site data
+        for them.
+        """
+        records = pandas.read_csv(COUNTRIES_PATH, dtype=str)
+        records = records.drop_duplicates('country').set_index(
+            'country', drop=False
+        )
+        records = records.astype(object).where(records.notna(), None)
+
+        protests = self.protests[COUNTRY_PAGE_PROTEST_COLUMNS].astype(object)
+        protests = protests.where(protests.notna(), None)
+        country_protests = {
+            name: group.to_dict('records')
+            for name, group in protests.groupby(
+                self.protest_countries.values, sort=False
+            )
+        }
+
+        for name in sorted(self.countries.index.values):
             urlsafe = country_name_urlsafe(name)
             perma = country_name_perma(name)
             filename = (Path(path) / Path(urlsafe)).with_suffix('.md')
             title = name
-            with open(filename, 'w', encoding='utf-8') as op:
-                op.write(f'---\n'
-                         f'layout: country\n'
-                         f'row_index: {i}\n'
-                         f'permalink: {perma}\n'
-                         f'title: {title}\n'
-                         f'hidden: true\n'
-                         f'---\n')
+            country = (records.loc[name].to_dict()
+                       if name in records.index else {})
+            write_if_changed(filename, front_matter({
+                'layout': 'country',
+                'permalink': perma,
+                'title': title,
+                'hidden': True,
+                'country': country,
+                'protests': country_protests.get(name, []),
+            }))
+
+    def protest_tags(self):
+        """
+        Return each protest's filter tags, as a list per protest of
+        dicts giving the filter's `name`, the `tag`, the `hash` that
+        selects that tag on the protest map, and the `count` of
+        protests with the tag. Tags are listed in
+        filter order, then in the order they appear in the sheet.
+        """
+        # Every protest with a tag shares the same record of it.
+        protest_tags = [[] for _ in range(len(self.protests))]
+        for col, tags in self.filters.items():
+            records = [
+                {'name': filter_name_clean(col),
+                 'tag': tag,
+                 'hash': filter_name_camel(col) + '-' + tag.replace(' ', '+'),
+                 'count': count}
+                if tag != '' else None
+                for tag, count in zip(tags.vocabulary,
+                                      tags.counts().tolist())
+            ]
+            for protest_ix, code in zip(tags.rows().tolist(),
+                                        tags.codes.tolist()):
+                if records[code] is not None:
+                    protest_tags[protest_ix].append(records[code])
+        return protest_tags
 
     def protest_pages(self, path):
-        for i, row_ix in enumerate(self.protests.index.values):
-            if i > 100:
-                break
-            row = self.protests.loc[row_ix]
-
-            perma = row['perma']
-
-            filename = protest_name_urlsafe(row_ix)
-            filename = (Path(path) / Path(filename)).with_suffix('.md')
-
-            title = row['Protest Name']
-            title = title.split('-')
-            title = f'{title[0]}, {title[1]} {title[2]}'
-
-            with open(filename, 'w', encoding='utf-8') as op:
-                op.write(f'---\n'
-                         f'layout: protest\n'
-                         f'row_index: {i}\n'
-                         f'permalink: {perma}\n'
-                         f'title: {title}\n'
-                         f'hidden: true\n'
-                         f'---\n')
-
-
-def save_embeds(include_path, tab_plot, patch_plot, point_plot, filters):
-    country_cb = ['callback-load-hash-coordinates-country']
-    protest_cb = ['callback-load-hash-coordinates-protests']
-
-    filter_cb = ['callback-load-hash-filter-' + filter_name_camel(f)
-                 for f in filters]
+        """
+        Write a page for every protest. Its front matter holds the
+        protest's fields and its filter tags, already split, so the
+        layout doesn't have to look anything up in the site data.
+        """
+        text_cols = [col for col in self.protests.columns
+                     if col not in self.filters
+                     and col not in PROTEST_NUMERIC_COLUMNS
+                     and col not in ('perma', 'geometry')]
+        fields = self.protests[text_cols].astype(object)
+        fields = fields.where(fields.notna(), None).to_dict('records')
+
+        names = self.protests['Protest Name'].astype(str)
+        parts = names.str.split('-')
+        titles = (parts.str[0] + ', ' + parts.str[1] + ' ' + parts.str[2])
+        titles = titles.where(titles.notna(), names)
+
+        filenames = [
+            (Path(path) / Path(protest_name_urlsafe(key))).with_suffix('.md')
+            for key in self.protests.index.values
+        ]
+        pages = zip(filenames, self.protests['perma'].values, titles.values,
+                    fields, self.protest_tags())
+        for i, (filename, perma, title, protest, tags) in enumerate(pages):
+            write_if_changed(filename, front_matter({
+                'layout': 'protest',
+                'row_index': i,
+                'permalink': perma,
+                'title': title,
+                'hidden': True,
+                'protest': protest,
+                'tags': tags,
+            }))
+
+
+def save_embeds(include_path, tab_plot, patch_plot, point_plot,
+                shared_path=None, shared_url=None, finish=True):
+    """
+    Write the Bokeh include files for the jekyll site. Any of the three
+    plots may be None, in which case the corresponding include is left
+    as it is; this lets an incremental build rewrite only the includes
+    whose inputs have changed.
+
+    If `shared_path` is given, the plots' data are saved there once, by
+    `shared_data`, for all the includes to load from `shared_url`,
+    instead of being embedded in each one.
+
+    If `finish` is false, `finish_embeds` is left for the caller to run
+    once every include is written, as it must be when several processes
+    write them at once.
+    """
+    country_cb = ['callback-load-hash-state-country']
+    protest_cb = ['callback-load-hash-state-protests',
+                  'callback-load-protest-tiles']
 
     include_path = Path(include_path)
-
-    with open(include_path / "map.html", 'w', encoding='utf-8') as op:
-        save_onload_callback(op, country_cb + protest_cb + filter_cb)
-        save_components(tab_plot, op)
-
-    with open(include_path / "country-map.html", 'w', encoding='utf-8') as op:
-        save_onload_callback(op, country_cb + filter_cb)
-        save_components(patch_plot, op)
-
-    with open(include_path / "protest-map.html", 'w', encoding='utf-8') as op:
-        save_onload_callback(op, protest_cb + filter_cb)
-        save_components(point_plot, op)
+    plots = [tab_plot, patch_plot, point_plot]
+
+    with shared_data(plots, shared_path, shared_url) as shared:
+        if tab_plot is not None:
+            path = include_path / "map.html"
+            with stage('embed-tab-map', [path]):
+                with open(path, 'w', encoding='utf-8') as op:
+                    save_onload_callback(op, country_cb + protest_cb,
+                                         shared)
+                    save_components(tab_plot, op)
+
+        if patch_plot is not None:
+            path = include_path / "country-map.html"
+            with stage('embed-country-map', [path]):
+                with open(path, 'w', encoding='utf-8') as op:
+                    save_onload_callback(op, country_cb, shared)
+                    save_components(patch_plot, op)
+
+        if point_plot is not None:
+            path = include_path / "protest-map.html"
+            with stage('embed-protest-map', [path]):
+                with open(path, 'w', encoding='utf-8') as op:
+                    save_onload_callback(op, protest_cb, shared)
+                    save_components(point_plot, op)
+
+    if finish:
+        finish_embeds(include_path, shared_path)
+
+
+def finish_embeds(include_path, shared_path=None):
+    """
+    Remove the shared data that no include uses any more, and write the
+    script tags that load BokehJS.
+    """
+    include_path = Path(include_path)
+    if shared_path is not None:
+        prune_shared_data(shared_path, include_path)
 
     # This ensures that the right version of BokehJS is always in use
     # on the jekyll site.
@@ -882,12 +3111,89 @@ def save_embeds(include_path, tab_plot, patch_plot, point_plot, filters):
         save_script_tags(op)
 
 
-def save_html(tab_plot, patch_plot, point_plot, filters):
-    country_cb = ['callback-load-hash-coordinates-country']
-    protest_cb = ['callback-load-hash-coordinates-protests']
+# Where the data shared by the embedded maps are saved, relative to the
+# jekyll site, and the size in bytes below which a data source is left
+# in the embeds, since fetching it would cost more than it saves.
+SHARED_DATA_PATH = 'assets/data/sources'
+SHARED_DATA_MIN_BYTES = 4096
+
+
+@contextmanager
+def shared_data(plots, path, url, min_bytes=SHARED_DATA_MIN_BYTES):
+    """
+    While the context lasts, move the data of the data sources in
+    `plots` out of the sources and into JSON files in `path`, so that
+    embeds made meanwhile don't include it. Sources used by several of
+    the plots are saved once. Each file is named by a digest of its
+    content, so the browser can cache it for as long as it likes, and
+    holds exactly what Bokeh would have put in the document.
+
+    Yields a dict giving, for the id of each emptied source, the name
+    of the emptied property and the URL of its data under `url`, for
+    `save_onload_callback`. If `path` is None, nothing is moved, and
+    the dict is empty.
+    """
+    sources = {}
+    if path is not None:
+        for plot in plots:
+            if plot is None:
+                continue
+            for model in plot.references():
+                if isinstance(model, (ColumnDataSource, GeoJSONDataSource)):
+                    sources[model.id] = model
+
+    shared = {}
+    moved = []
+    try:
+        with stage('shared-data', [] if path is None else [path]):
+            for source in sources.values():
+                if isinstance(source, GeoJSONDataSource):
+                    prop = 'geojson'
+                    value = text = source.geojson
+                    empty = '{"type": "FeatureCollection", "features": []}'
+                else:
+                    prop = 'data'
+                    value = dict(source.data)
+                    text = serialize_json(
+                        source.lookup('data').serializable_value(source),
+                        pretty=False
+                    )
+                    empty = {col: [] for col in value}
+                if len(text) < min_bytes:
+                    continue
+
+                digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+                name = digest[:16] + '.json'
+                Path(path).mkdir(parents=True, exist_ok=True)
+                write_if_changed(Path(path) / name, text)
+
+                shared[source.id] = [prop, f'{url}/{name}']
+                moved.append((source, prop, value))
+                setattr(source, prop, empty)
+        yield shared
+    finally:
+        for source, prop, value in moved:
+            setattr(source, prop, value)
+
+
+def prune_shared_data(path, include_path):
+    """
+    Delete the files in `path` that no include in `include_path` loads
+    any more.
+    """
+    used = set()
+    for include in Path(include_path).glob('*.html'):
+        text = include.read_text(encoding='utf-8')
+        used.update(re.findall(r'[0-9a-f]{16}\.json', text))
+    for stale in Path(path).glob('*.json'):
+        if stale.name not in used:
+            stale.unlink()
+
 
-    filter_cb = ['callback-load-hash-filter-' + filter_name_camel(f)
-                 for f in filters]
+def save_html(tab_plot, patch_plot, point_plot):
+    country_cb = ['callback-load-hash-state-country']
+    protest_cb = ['callback-load-hash-state-protests',
+                  'callback-load-protest-tiles']
 
     with open("map-tab-standalone.html", 'w', encoding='utf-8') as op:
         op.write("""
@@ -896,8 +3202,8 @@ def save_html(tab_plot, patch_plot, point_plot, filters):
         """)
 
         save_script_tags(op)
+        save_onload_callback(op, country_cb + protest_cb)
         save_components(tab_plot, op)
-        save_onload_callback(op, country_cb + protest_cb + filter_cb)
 
         op.write("""
         <div id="map-hover-context">
@@ -912,8 +3218,8 @@ def save_html(tab_plot, patch_plot, point_plot, filters):
         """)
 
         save_script_tags(op)
+        save_onload_callback(op, country_cb)
         save_components(patch_plot, op)
-        save_onload_callback(op, country_cb + filter_cb)
 
         op.write("""
         <div id="map-hover-context">
@@ -928,8 +3234,8 @@ def save_html(tab_plot, patch_plot, point_plot, filters):
         """)
 
         save_script_tags(op)
+        save_onload_callback(op, protest_cb)
         save_components(point_plot, op)
-        save_onload_callback(op, protest_cb + filter_cb)
 
         op.write("""
         <div id="map-hover-context">
@@ -962,41 +3268,30 @@ def save_components(plot, open_file):
         open_file.write('\n')
 
 
-def save_onload_callback(open_file, callback_names):
-    """
-    Create a callback that sets an interval to call a function
-    after some delay. The function causes the Bokeh map to zoom
-    to a particular set of coordinates. The delay starts at 16
-    milliseconds, so that if the Boekh document loads quicky,
-    we snappily zoom to the correct location. Otherwise, the
-    interval is reset. But we don't want to bog the browser down
-    with busy-waiting for the document to load, especially if
-    it is broken and will never load! So we double the delay each
-    time -- this is called exponential backoff, and it's closely
-    related to exponential search. I think if anyone learns any
-    computer-science-related thing, it should be this! It's a
-    useful stratgey in all kinds of situations, big and small.
-
-    It has the very nice property that the total time spent waiting
-    is never more than twice what it absolutely must be, while
-    guaranteeing that the amount of time we spend uselessly
-    checking for an update is proportional to the logarithm
-    of the total time spent waiting -- which is, relatively
-    speaking, a very, very small number.
-
-    For example, if we wind up waiting 2 ** 14 milliseconds,
-    or about sixteen seconds, we only check to see what's with
-    the Bokeh document fourteen times! (Actually, it winds up
-    being ten times, since we start at 2 ** 4 = 16 milliseconds.)
-    If we just kept on checking every 16 milliseconds, we'd wind
-    up checking more than a thousand times! So we really cut down
-    on the amount of spammy work we make the browser do without
-    sacrificing all that much usability.
-
-    We could adjust that balance by using a floating point number
-    less than 2 and greater than 1. 1.25 would lead us to check
-    about thirty times in 16 seconds. In 16 minutes, it would
-    lead us to check only about fifty times.
+def save_onload_callback(open_file, callback_names, shared=None):
+    """
+    Write a script that runs the named Bokeh callbacks, which restore
+    the map's state from the URL fragment, as soon as the Bokeh document
+    is ready.
+
+    The document doesn't exist yet when the script runs: Bokeh creates
+    it later, when the components' own script calls `embed_items`. So we
+    wrap `embed_items`, and when it has made the document, wait for the
+    document's `idle` signal, which Bokeh emits once every plot in it
+    has been built and drawn. There's no need to poll. Each callback
+    runs once per document. The script must therefore be written
+    before the components.
+
+    The wrapper relies on the signature of BokehJS's `embed_items`. If
+    that isn't the one we expect, the script leaves it alone, watches
+    the page for new documents instead, and fills in their shared data
+    after Bokeh has loaded them.
+
+    `shared` describes the data sources whose data were left out of the
+    document by `shared_data`. Their data are fetched as soon as the
+    script runs, and put back into the document's JSON before Bokeh
+    loads it, so the plots are drawn once, with all their data, before
+    the callbacks run.
     """
 
     # NOTE: Indented code will be formatted by the markdown engine
@@ -1017,118 +3312,708 @@ def save_onload_callback(open_file, callback_names):
     open_file.write("""
 <script type="text/javascript">
   (function() {
+    const callbackNames = """ + json.dumps(callback_names) + """;
+    const sharedData = """ + json.dumps(shared or {}) + """;
+
+    // Start fetching the shared data right away.
+    let downloads = {};
+    for (const [id, [prop, url]] of Object.entries(sharedData)) {
+      downloads[id] = fetch(url).then(response => {
+        return prop === 'geojson' ? response.text() : response.json();
+      });
+    }
+
+    // Bokeh passes the document's JSON to `embed_items` as an
+    // HTML-escaped string.
+    let parseDocs = function(docsJson) {
+      if (typeof docsJson !== 'string') {
+        return docsJson;
+      }
+      const entities = {amp: '&', lt: '<', gt: '>', quot: '"',
+                        '#x27': "'", '#x60': '`'};
+      return JSON.parse(docsJson.replace(
+        /&(amp|lt|gt|quot|#x27|#x60);/g, (_, entity) => entities[entity]
+      ));
+    };
+
+    // Put the shared data back into the document's models.
+    let fillShared = function(docsJson) {
+      if (Object.keys(sharedData).length === 0) {
+        return Promise.resolve(docsJson);
+      }
+      const docs = parseDocs(docsJson);
+      const filled = [];
+      for (const doc of Object.values(docs)) {
+        for (const model of doc.roots.references) {
+          if (model.id in downloads) {
+            const prop = sharedData[model.id][0];
+            filled.push(downloads[model.id].then(value => {
+              model.attributes[prop] = value;
+            }));
+          }
+        }
+      }
+      return Promise.all(filled).then(() => docs);
+    };
 
-    // A function that accepts an array of bokeh callback names, and
-    // executes all of them.
-    let execBokehCallbacks = function(callbackNames) {
+    // Execute the named callbacks of a Bokeh document.
+    let execBokehCallbacks = function(doc) {
+      if (doc.spa_restored) {
+        return;
+      }
+      doc.spa_restored = true;
       for (const cbn of callbackNames) {
-        let bokehCallback = window.Bokeh.documents[0].get_model_by_name(cbn);
+        let bokehCallback = doc.get_model_by_name(cbn);
         if (bokehCallback !== null) {
           bokehCallback.execute();
         }
       }
     };
 
-    window.addEventListener('DOMContentLoaded', function(event) {
-      let delay = 16;
-      console.log('delay ', delay);
-      let intervalfunc = function() {
-        window.clearInterval(checkfunc);
-        console.log('delay ', delay);
-        if (window.Bokeh && window.Bokeh.documents.length > 0) {
-          const callbackNames = ['""" +
-                    "', '".join(callback_names) +
-                    """'];
-          execBokehCallbacks(callbackNames);
-        } else if (delay < 2 ** 20) {
-          delay = delay * 2;
-          checkfunc = window.setInterval(intervalfunc, delay);
-          console.log('resetting interval with delay ', delay);
+    let whenIdle = function(doc) {
+      if (doc.is_idle) {
+        execBokehCallbacks(doc);
+      } else {
+        doc.idle.connect(() => execBokehCallbacks(doc));
+      }
+    };
+
+    // Put the shared data into a document that Bokeh has already
+    // loaded without them, through the models' public setters.
+    let fillLoaded = function(doc) {
+      const filled = [];
+      for (const [id, [prop]] of Object.entries(sharedData)) {
+        const model = doc.get_model_by_id(id);
+        if (model !== null) {
+          filled.push(downloads[id].then(value => {
+            model.setv({[prop]: value});
+          }));
         }
-      };
-      let checkfunc = window.setInterval(intervalfunc, delay);
-    });
+      }
+      return Promise.all(filled);
+    };
 
+    let restore = function(doc) {
+      fillLoaded(doc).then(() => whenIdle(doc));
+    };
+
+    if (window.Bokeh === undefined) {
+      console.error('BokehJS must be loaded before the map state script');
+      return;
+    }
+
+    // Documents embedded before this script ran, if any.
+    for (const doc of window.Bokeh.documents) {
+      restore(doc);
+    }
+
+    // Documents embedded from now on. BokehJS 2.1 declares
+    // embed_items(docs_json, render_items, app_path, absolute_url).
+    const embedItems = (window.Bokeh.embed || {}).embed_items;
+    if (typeof embedItems !== 'function' || embedItems.length !== 4) {
+      // Some other BokehJS: rather than wrap a function we don't know,
+      // watch the page for new documents, and fill in their shared
+      // data once they're loaded. The plots are drawn twice.
+      console.warn('Unexpected Bokeh.embed.embed_items; ' +
+                   'filling in the map data after embedding');
+      let known = window.Bokeh.documents.length;
+      new MutationObserver(() => {
+        for (const doc of window.Bokeh.documents.slice(known)) {
+          restore(doc);
+        }
+        known = window.Bokeh.documents.length;
+      }).observe(document.documentElement, {childList: true, subtree: true});
+      return;
+    }
+
+    window.Bokeh.embed.embed_items = function(docsJson, ...args) {
+      return fillShared(docsJson).then(docs => {
+        const known = window.Bokeh.documents.length;
+        return embedItems.call(this, docs, ...args).then(views => {
+          for (const doc of window.Bokeh.documents.slice(known)) {
+            whenIdle(doc);
+          }
+          return views;
+        });
+      });
+    };
   })();
 </script>
     """)
 
 
-def main(embed=True, export_point_pngs=False):
+# The files the map build reads, keyed by the names the build state
+# uses for them. `code` is this script, so that changing how the map
+# is built invalidates everything built by the old version.
+BUILD_INPUTS = {
+    'protests': PROTESTS_PATH,
+    'countries': COUNTRIES_PATH,
+    'geojson': GEOJSON_PATH,
+    'code': __file__,
+    'mvt': mvt.__file__,
+}
+
+# The outputs of an embedded build, and the inputs each one derives
+# from. An output is regenerated only when one of its inputs changes.
+BUILD_TARGETS = {
+    'country-pages': ('countries', 'protests', 'geojson', 'code'),
+    'protest-pages': ('protests', 'code'),
+    'country-map': ('protests', 'geojson', 'code'),
+    'protest-map': ('protests', 'code'),
+    'tab-map': ('protests', 'geojson', 'code'),
+    'vector-tiles': ('protests', 'code', 'mvt'),
+}
+
+# The options of `main` that change each target's output. Changing one
+# regenerates the targets it affects, like changing an input does.
+BUILD_TARGET_OPTIONS = {
+    'country-pages': (),
+    'protest-pages': (),
+    'country-map': ('tile_url', 'share_data'),
+    'protest-map': ('tile_url', 'compact', 'lazy_details', 'share_data',
+                    'vector_tiles'),
+    'tab-map': ('tile_url', 'compact', 'lazy_details', 'share_data',
+                'vector_tiles'),
+    'vector-tiles': (),
+}
+
+BUILD_STATE_PATH = 'data_to_map/.build-state.json'
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Return the SHA-256 hex digest of the file at `path`, or None if
+    there is no such file.
+    """
+    sha = hashlib.sha256()
+    try:
+        with open(path, 'rb') as ip:
+            for chunk in iter(lambda: ip.read(chunk_size), b''):
+                sha.update(chunk)
+    except FileNotFoundError:
+        return None
+    return sha.hexdigest()
+
+
+# The map code: this script and the modules it imports from beside it.
+# Only the script and `mvt` are build inputs; the other modules change
+# how the map is built or watched, but not what is built.
+CODE_FILES = [__file__, mvt.__file__, thumbnails.__file__,
+              schedule.__file__, watch.__file__]
+
+# The digests of the code as it was imported, keyed by path. A build is
+# made by the code the process loaded, whatever has since been saved
+# over it.
+LOADED_CODE_DIGESTS = {path: file_digest(path) for path in CODE_FILES}
+
+
+def input_digests(inputs=BUILD_INPUTS):
+    return {name: (LOADED_CODE_DIGESTS[path] if path in LOADED_CODE_DIGESTS
+                   else file_digest(path))
+            for name, path in inputs.items()}
+
+
+def code_changed():
+    """
+    Return whether the map code on disk differs from the code this
+    process is running, in which case only a new process can build with
+    it.
+    """
+    return any(file_digest(path) != digest
+               for path, digest in LOADED_CODE_DIGESTS.items())
+
+
+class BuildState:
+    """
+    A record of the input digests, and the options that affect it, each
+    build target was last built with.
+    It lives in a small JSON file next to the data, so that it survives
+    restarts of the watcher.
+    """
+
+    def __init__(self, path=BUILD_STATE_PATH, targets=BUILD_TARGETS,
+                 target_options=BUILD_TARGET_OPTIONS):
+        self.path = Path(path)
+        self.targets = targets
+        self.target_options = target_options
+        try:
+            with open(self.path, encoding='utf-8') as ip:
+                self.built = json.load(ip)
+        except (OSError, ValueError):
+            self.built = {}
+
+    def entry(self, target, digests, options):
+        entry = {i: digests[i] for i in self.targets[target]}
+        entry['options'] = {o: options[o]
+                            for o in self.target_options.get(target, ())}
+        return entry
+
+    def stale_targets(self, digests, options):
+        """
+        Return the targets whose inputs or options differ from the ones
+        they were last built with, in declaration order.
+        """
+        return [target for target in self.targets
+                if self.built.get(target) !=
+                self.entry(target, digests, options)]
+
+    def record(self, target, digests, options):
+        self.built[target] = self.entry(target, digests, options)
+
+    def save(self):
+        # Write to a temporary file first, so that a build interrupted
+        # mid-write can't leave a truncated state file behind.
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as op:
+            json.dump(self.built, op, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def incremental_build(state, **options):
+    """
+    Rebuild just the targets whose inputs, or the options that affect
+    them, have changed since they were last built. Returns the list of
+    targets that were rebuilt, which is empty if nothing changed -- for
+    example, if a file was re-saved without modification. Other
+    `options` are passed on to `main`.
+    """
+    digests = input_digests()
+    built_with = {name: param.default for name, param
+                  in inspect.signature(main).parameters.items()}
+    built_with.update(options)
+    stale = state.stale_targets(digests, built_with)
+    if not built_with['vector_tiles']:
+        # Nothing loads the tiles without the option, so they're neither
+        # built nor recorded as built, until it's given.
+        stale = [target for target in stale if target != 'vector-tiles']
+    if not stale:
+        return stale
+
+    print("Rebuilding: " + ", ".join(stale))
+    main(targets=set(stale), **options)
+
+    for target in stale:
+        state.record(target, digests, built_with)
+    state.save()
+    return stale
+
+
+def main(embed=True, export_point_pngs=False, targets=None,
+         tile_url=None, workers=None, force=False, static_pngs=True,
+         compact=True, lazy_details=False, share_data=False,
+         vector_tiles=False, profile=None, profile_stats=None):
+    """
+    Build the maps. When `embed` is true, `targets` may name a subset of
+    BUILD_TARGETS to regenerate; by default, all of them are rebuilt.
+    `tile_url` replaces the MapTiler tile sources, for example with a
+    local tile server for testing. If `lazy_details` is true, the point
+    map loads its hover panel's text from separate files (embedded
+    builds only). If `share_data` is true, the maps' data are saved once
+    in files that all the embeds load, instead of being embedded in
+    each (embedded builds only). If `vector_tiles` is true, the build
+    writes the vector tiles, and the point map loads the protests from
+    them; otherwise, the tiles are left as they are (embedded builds
+    only).
+
+    `workers` is the number of processes to export the PNGs with or, for
+    embedded builds, to run the independent stages of the build in; see
+    `schedule.StageScheduler`. By default, there is one per CPU. The
+    command line's watcher passes one unless `--workers` is given, so
+    that an ordinary edit doesn't fork a fresh pool.
+
+    If `profile` names a file, the cost of each stage of the build is
+    appended to it; see `StageProfiler`. If `profile_stats` names a
+    directory as well, a cProfile dump of each stage is saved there.
+    """
+    global _profiler
+    if profile is not None:
+        _profiler = StageProfiler(profile, profile_stats)
+    try:
+        build(embed, export_point_pngs, targets, tile_url, workers, force,
+              static_pngs, compact, lazy_details, share_data, vector_tiles)
+    finally:
+        if _profiler is not None:
+            _profiler.close()
+            _profiler = None
+
+
+def build(embed, export_point_pngs, targets, tile_url, workers, force,
+          static_pngs, compact, lazy_details, share_data, vector_tiles):
     patch_key = ('https://api.maptiler.com/maps/voyager/{z}/{x}/{y}.png?'
                  'key=k3o6yW6gLuLZpwLM3ecn')
     point_key = ('https://api.maptiler.com/maps/outdoor/{z}/{x}/{y}.png?'
                  'key=k3o6yW6gLuLZpwLM3ecn')
+    if tile_url is not None:
+        patch_key = point_key = tile_url
+
+    if targets is None:
+        targets = set(BUILD_TARGETS)
 
     map = Map()
 
     if export_point_pngs:
-        map.individual_point_plots(point_key)
+        path = 'docs/assets/img/protest-points'
+        with stage('point-pngs', [path]):
+            map.individual_point_plots(point_key, path=path,
+                                       workers=workers, force=force,
+                                       static=static_pngs)
+    elif embed:
+        # The top-level directory for our jekyll site is "docs" so that
+        # github pages can build (most of) the site.
+        #
+        # Each stage writes its own files. A map's embed waits for the
+        # files it loads, so the site never links to ones not yet
+        # written.
+        scheduler = schedule.StageScheduler(workers, stage)
+        if 'vector-tiles' in targets and vector_tiles:
+            path = Path('docs') / VECTOR_TILE_PATH
+            scheduler.add('vector-tiles', map.save_vector_tiles, path,
+                          artifacts=[path])
+        if 'country-pages' in targets:
+            scheduler.add('country-pages', map.country_pages,
+                          'docs/_countries', artifacts=['docs/_countries'])
+        if 'protest-pages' in targets:
+            scheduler.add('protest-pages', map.protest_pages,
+                          'docs/_protests', artifacts=['docs/_protests'])
+
+        if targets & {'country-map', 'tab-map'}:
+            path = Path('docs') / COUNTRY_LOD_PATH
+            with stage('country-topology'):
+                levels = map.country_levels()
+            scheduler.add('country-levels', save_country_levels, path,
+                          levels, artifacts=[path])
+        details_url = None
+        if targets & {'protest-map', 'tab-map'} and lazy_details and compact:
+            path = Path('docs') / DETAIL_SHARD_PATH
+            scheduler.add('detail-shards', map.save_detail_shards, path,
+                          artifacts=[path])
+            details_url = '/spa/' + DETAIL_SHARD_PATH
+        tiles_url = None
+        point_deps = ['detail-shards']
+        if vector_tiles:
+            tiles_url = '/spa/' + VECTOR_TILE_PATH
+            point_deps.append('vector-tiles')
+
+        # The plots are built once, here, before the scheduler forks its
+        # workers, so that every embed stage shares them.
+        patch_vis = point_vis = None
+        if targets & {'country-map', 'tab-map'}:
+            with stage('patch-plot'):
+                patch_vis = map.patch_plot(
+                    patch_key, levels_url='/spa/' + COUNTRY_LOD_PATH
+                )
+        if targets & {'protest-map', 'tab-map'}:
+            with stage('point-plot'):
+                point_vis = map.point_plot(point_key, compact=compact,
+                                           details_url=details_url,
+                                           tiles_url=tiles_url)
+
+        shared_path = shared_url = None
+        if share_data:
+            shared_path = Path('docs') / SHARED_DATA_PATH
+            shared_url = '/spa/' + SHARED_DATA_PATH
+
+        def embed(tab, patch, point):
+            save_embeds('docs/_includes', tab, patch, point,
+                        shared_path, shared_url, finish=False)
+
+        def detached(plot):
+            # Bokeh leaves a plot embedded on its own as the root of a
+            # document, which it must leave before it can go in the tabs.
+            if plot.document is not None:
+                plot.document.remove_root(plot)
+            return plot
+
+        if 'country-map' in targets:
+            scheduler.add('country-map', embed, None, patch_vis, None,
+                          deps=['country-levels'])
+        if 'protest-map' in targets:
+            scheduler.add('protest-map', embed, None, None, point_vis,
+                          deps=point_deps)
+        if 'tab-map' in targets:
+            scheduler.add('tab-map', lambda: embed(Tabs(tabs=[
+                Panel(child=detached(patch_vis), title="Country View"),
+                Panel(child=detached(point_vis), title="Protest View")
+            ]), None, None), deps=['country-levels'] + point_deps)
+
+        scheduler.run()
+        scheduler.report()
+        finish_embeds('docs/_includes', shared_path)
+
+        # Force index and protest map to re-render.
+        # Not sure this actually works.
+        with stage('touch'):
+            Path('docs/_includes/bokeh_heading.html').touch()
+            if 'country-map' in targets:
+                Path('docs/index.markdown').touch()
+                Path('docs/_includes/country-map.html').touch()
+            if 'protest-map' in targets:
+                Path('docs/full-protest-map.markdown').touch()
+                Path('docs/_includes/protest-map.html').touch()
     else:
-        patch_vis = map.patch_plot(patch_key)
-        point_vis = map.point_plot(point_key)
+        with stage('patch-plot'):
+            patch_vis = map.patch_plot(patch_key)
+        with stage('point-plot'):
+            point_vis = map.point_plot(point_key, compact=compact)
         tab_vis = Tabs(tabs=[Panel(child=patch_vis, title="Country View"),
                              Panel(child=point_vis, title="Protest View")])
+        with stage('save-html', ['map-tab-standalone.html',
+                                 'map-country-standalone.html',
+                                 'map-protest-standalone.html']):
+            save_html(tab_vis, patch_vis, point_vis)
+
+
+PROFILE_PATH = 'data_to_map/.profile.jsonl'
+
+# The profiler for the build in progress, if it's being profiled. It's
+# module-level so that `stage` can be used anywhere in the build without
+# passing it around.
+_profiler = None
+
+
+@contextmanager
+def stage(name, artifacts=()):
+    """
+    Mark a stage of the build, which writes the files or directories in
+    `artifacts`, if any. Does nothing unless the build is being
+    profiled.
+    """
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.stage(name, artifacts):
+            yield
+
+
+def artifact_bytes(path):
+    path = Path(path)
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
 
-        if embed:
-            # The top-level directory for our jekyll site is "docs" so that
-            # github pages can build (most of) the site.
-            map.country_pages('docs/_countries')
-            map.protest_pages('docs/_protests')
-            save_embeds('docs/_includes',
-                        tab_vis, patch_vis, point_vis,
-                        list(map.filters.keys()))
-
-            # Force index and protest map to re-render.
-            # Not sure this actually works.
-            Path('docs/index.markdown').touch()
-            Path('docs/full-protest-map.markdown').touch()
-            Path('docs/_includes/bokeh_heading.html').touch()
-            Path('docs/_includes/country-map.html').touch()
-            Path('docs/_includes/protest-map.html').touch()
-        else:
-            save_html(tab_vis, patch_vis, point_vis, list(map.filters.keys()))
+
+class StageProfiler:
+    """
+    Append a JSON line to `path` for each stage of a build, giving its
+    wall and CPU time in seconds, the peak resident set size so far in
+    kilobytes, and the size in bytes of each artifact it wrote. CPU time
+    and peak RSS are those of the process that ran the stage, which is
+    a worker's for the stages a `schedule.StageScheduler` runs in
+    parallel, and whose `pid` the line gives. The CPU time of worker
+    processes the stage itself started and waited for, as PNG export
+    does, is given separately, as `children_cpu_s`. A final line, for
+    the stage named "build", covers the whole build, including the peak
+    RSS of its largest worker, and records digests of its inputs, so
+    that profiles of different data snapshots can be told apart. Lines
+    from one build share a `build` timestamp.
+
+    If `stats_dir` is given, a cProfile dump of each stage is saved
+    there too, as `<build>-<stage>.pstats`; stages nested inside another
+    stage are covered by the outer stage's dump.
+    """
+
+    def __init__(self, path=PROFILE_PATH, stats_dir=None):
+        self.path = Path(path)
+        self.stats_dir = None if stats_dir is None else Path(stats_dir)
+        self.build = time.strftime('%Y%m%dT%H%M%S')
+        self.start_wall = time.perf_counter()
+        self.start_cpu = self.cpu_time()
+        self.start_children_cpu = self.cpu_time(resource.RUSAGE_CHILDREN)
+        self.profiling = False
+
+    @staticmethod
+    def cpu_time(who=resource.RUSAGE_SELF):
+        usage = resource.getrusage(who)
+        return usage.ru_utime + usage.ru_stime
+
+    @staticmethod
+    def peak_rss(who=resource.RUSAGE_SELF):
+        return resource.getrusage(who).ru_maxrss
+
+    def write(self, record):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as op:
+            op.write(json.dumps(record) + '\n')
+
+    @contextmanager
+    def stage(self, name, artifacts=()):
+        profile = None
+        if self.stats_dir is not None and not self.profiling:
+            profile = cProfile.Profile()
+            self.profiling = True
+            profile.enable()
+
+        start_wall = time.perf_counter()
+        start_cpu = self.cpu_time()
+        start_children_cpu = self.cpu_time(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = self.cpu_time() - start_cpu
+            children_cpu = (self.cpu_time(resource.RUSAGE_CHILDREN) -
+                            start_children_cpu)
+            if profile is not None:
+                profile.disable()
+                self.profiling = False
+                self.stats_dir.mkdir(parents=True, exist_ok=True)
+                profile.dump_stats(
+                    self.stats_dir / f'{self.build}-{name}.pstats'
+                )
+
+            sizes = {str(path): artifact_bytes(path) for path in artifacts}
+            self.write({
+                'build': self.build,
+                'stage': name,
+                'pid': os.getpid(),
+                'wall_s': round(wall, 6),
+                'cpu_s': round(cpu, 6),
+                'children_cpu_s': round(children_cpu, 6),
+                'peak_rss_kb': self.peak_rss(),
+                'bytes': sum(sizes.values()),
+                'artifacts': sizes,
+            })
+
+    def close(self):
+        self.write({
+            'build': self.build,
+            'stage': 'build',
+            'pid': os.getpid(),
+            'wall_s': round(time.perf_counter() - self.start_wall, 6),
+            'cpu_s': round(self.cpu_time() - self.start_cpu, 6),
+            'children_cpu_s': round(
+                self.cpu_time(resource.RUSAGE_CHILDREN) -
+                self.start_children_cpu, 6
+            ),
+            'peak_rss_kb': self.peak_rss(),
+            'children_peak_rss_kb': self.peak_rss(resource.RUSAGE_CHILDREN),
+            'inputs': {name: digest and digest[:16]
+                       for name, digest in input_digests().items()},
+        })
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate the School Protests in Africa maps. By "
+                    "default, build the jekyll includes and pages, and "
+                    "then watch the input data for changes."
+    )
+    parser.add_argument('--standalone', action='store_true',
+                        help="write standalone HTML maps and exit")
+    parser.add_argument('--export-point-pngs', action='store_true',
+                        help="export a PNG map for each protest and exit; "
+                             "the maps are drawn from cached tiles, which "
+                             "looks a little different from the Bokeh "
+                             "maps that --browser renders")
+    parser.add_argument('--browser', action='store_true',
+                        help="export PNGs by rendering each map with Bokeh "
+                             "in a headless browser, as before the tile "
+                             "cache, instead of drawing them from cached "
+                             "tiles")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of processes to use when exporting "
+                             "PNGs (default: one per CPU) or rebuilding "
+                             "the site while watching (default: one)")
+    parser.add_argument('--force', action='store_true',
+                        help="export every PNG, even those that are "
+                             "up to date")
+    parser.add_argument('--full-embed', action='store_true',
+                        help="embed two full copies of the protest data in "
+                             "the protest map, instead of one copy of just "
+                             "the columns it uses")
+    parser.add_argument('--lazy-details', action='store_true',
+                        help="leave the protest descriptions out of the "
+                             "embedded protest map, and load them when "
+                             "the hover panel first needs them")
+    parser.add_argument('--shared-data', action='store_true',
+                        help="save the data of the embedded maps once, in "
+                             "files they all load, instead of embedding "
+                             "it in each of them")
+    parser.add_argument('--vector-tiles', action='store_true',
+                        help="leave the protests out of the embedded "
+                             "protest map, and load them from the vector "
+                             "tiles in view")
+    parser.add_argument('--tile-url', default=None,
+                        help="tile URL template to use instead of "
+                             "MapTiler, e.g. a local tile server")
+    parser.add_argument('--profile', nargs='?', const=PROFILE_PATH,
+                        default=None, metavar='PATH',
+                        help="append the time, memory and output size of "
+                             "each build stage to PATH as JSON lines "
+                             f"(default: {PROFILE_PATH})")
+    parser.add_argument('--profile-stats', default=None, metavar='DIR',
+                        help="with --profile, also save a cProfile dump "
+                             "of each stage in DIR")
+    parser.add_argument('--poll', action='store_true',
+                        help="watch for changes by polling, even if "
+                             "inotify is available")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
+    args = parse_args()
 
-    if '--standalone' in sys.argv[1:]:
+    if args.standalone:
         print("Generating standalone map...")
-        main(embed=False)
-    elif '--export-point-pngs' in sys.argv[1:]:
+        main(embed=False, tile_url=args.tile_url,
+             compact=not args.full_embed, profile=args.profile,
+             profile_stats=args.profile_stats)
+    elif args.export_point_pngs:
         print("Generating point pngs")
-        main(export_point_pngs=True)
+        main(export_point_pngs=True, tile_url=args.tile_url,
+             workers=args.workers, force=args.force,
+             static_pngs=not args.browser, profile=args.profile,
+             profile_stats=args.profile_stats)
     else:
         # Get the default signal handler for SIGTERM (see below)
         default_sigterm = signal.getsignal(signal.SIGTERM)
 
-        # We set these variables to keep track of changes
-        last_mod_time = 0
-        new_mod_time = 0
-        init = True
-        print("Watching input directory for changes every ten seconds.")
-        while True:
-            data_files = list(Path("data_to_map/data").iterdir())
-            data_files.append(Path(__file__).resolve())
-            for data_file in data_files:
-                mod_time = os.path.getmtime(data_file)
-                if mod_time > new_mod_time:
-                    new_mod_time = mod_time
-
-            if init:
-                init = False
-                last_mod_time = new_mod_time
-
-            if new_mod_time > last_mod_time:
-                last_mod_time = new_mod_time
-                print("Change detected, generating new map...")
-                main()
-                print("Map generation complete.")
-                print("Watching for changes...")
-
-            # Listen for SIGTERM from docker while sleeping.
-            signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
-            time.sleep(10)
-            # Ignore SIGTERM while working.
-            signal.signal(signal.SIGTERM, default_sigterm)
-            # foo
+        # The build state remembers which inputs each output was built
+        # from, so the watchers only tell us when to *look* for changes.
+        # What actually gets rebuilt depends on which inputs' contents
+        # differ from the last build.
+        state = BuildState()
+
+        def rebuild():
+            if code_changed():
+                # Start over with the new code, which will catch up on
+                # whatever it changes. The inotify watch is closed on
+                # exec.
+                print("The map code changed; restarting.")
+                sys.stdout.flush()
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+            return incremental_build(state, tile_url=args.tile_url,
+                                     compact=not args.full_embed,
+                                     lazy_details=args.lazy_details,
+                                     share_data=args.shared_data,
+                                     vector_tiles=args.vector_tiles,
+                                     workers=args.workers or 1,
+                                     profile=args.profile,
+                                     profile_stats=args.profile_stats)
+
+        # Start watching before the first build, so that we don't miss
+        # changes made while it runs.
+        watcher = None
+        if not args.poll:
+            try:
+                watcher = watch.InotifyWatcher({
+                    'data_to_map/data': None,
+                    Path(__file__).resolve().parent: [
+                        Path(path).name for path in CODE_FILES
+                    ],
+                })
+            except OSError as exc:
+                print(f"Can't use inotify ({exc}); falling back to polling.")
+
+        # Catch up on anything that changed while we weren't watching.
+        # If nothing did, this is a no-op.
+        rebuild()
+
+        if watcher is not None:
+            watch.watch_inotify(watcher, rebuild, default_sigterm)
+        else:
+            watch.watch_polling(rebuild, default_sigterm, 'data_to_map/data',
+                                CODE_FILES)
@@ -0,0 +1,174 @@
+"""
+A small encoder for Mapbox Vector Tiles, version 2.1 of the spec:
+https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+
+It covers just what the map needs, which is point features with string
+and number properties, in web mercator z/x/y tiles. The protocol
+buffers are written by hand, so the build needs nothing more than NumPy.
+"""
+import math
+import struct
+import numbers
+from collections import defaultdict
+
+import numpy
+
+# The same as in map.py, which imports this module.
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+# Tile coordinates run from 0 to EXTENT across a tile.
+EXTENT = 4096
+
+POINT = 1
+
+MOVE_TO = 1
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+
+
+def varint(n):
+    """Encode a non-negative integer as a protocol buffer varint."""
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(n):
+    """Map a signed integer to an unsigned one, small for small |n|."""
+    return (n << 1) if n >= 0 else (-n << 1) - 1
+
+
+def field_key(field, wire_type):
+    return varint(field << 3 | wire_type)
+
+
+def length_delimited(field, payload):
+    return field_key(field, LENGTH_DELIMITED) + varint(len(payload)) + payload
+
+
+def packed(field, values):
+    return length_delimited(field, b''.join(varint(int(v)) for v in values))
+
+
+def command(command_id, count):
+    return command_id | count << 3
+
+
+def zigzag_deltas(points):
+    """The differences between consecutive points of an (n, 2) integer
+    array, starting from (0, 0), zigzag encoded and flattened."""
+    deltas = numpy.diff(points, axis=0, prepend=[[0, 0]]).ravel()
+    return ((deltas << 1) ^ (deltas >> 63)).tolist()
+
+
+def point_commands(points):
+    """The geometry commands for the points in an (n, 2) array of tile
+    coordinates."""
+    return [command(MOVE_TO, len(points))] + zigzag_deltas(points)
+
+
+def encode_value(value):
+    if isinstance(value, str):
+        return length_delimited(1, value.encode('utf-8'))
+    if isinstance(value, (bool, numpy.bool_)):
+        return field_key(7, VARINT) + varint(int(value))
+    if isinstance(value, numbers.Integral):
+        value = int(value)
+        if value >= 0:
+            return field_key(5, VARINT) + varint(value)
+        return field_key(6, VARINT) + varint(zigzag(value))
+    return field_key(3, FIXED64) + struct.pack('<d', float(value))
+
+
+def encode_layer(name, features, extent=EXTENT):
+    """
+    Encode a layer of `features`, each a `(type, commands, properties)`
+    tuple. Property keys and values are stored once per layer, however
+    many features share them. Properties that are None or NaN are left
+    out.
+    """
+    keys, values = {}, {}
+    encoded = []
+    for geom_type, commands, properties in features:
+        tags = []
+        for k, v in properties.items():
+            if v is None or (isinstance(v, float) and math.isnan(v)):
+                continue
+            tags.append(keys.setdefault(k, len(keys)))
+            tags.append(values.setdefault(encode_value(v), len(values)))
+        encoded.append(length_delimited(2, b''.join([
+            packed(2, tags),
+            field_key(3, VARINT) + varint(geom_type),
+            packed(4, commands),
+        ])))
+
+    return b''.join(
+        [length_delimited(1, name.encode('utf-8'))] +
+        encoded +
+        [length_delimited(3, k.encode('utf-8')) for k in keys] +
+        [length_delimited(4, v) for v in values] +
+        [field_key(5, VARINT) + varint(extent),
+         field_key(15, VARINT) + varint(2)]
+    )
+
+
+def encode_tile(layers, extent=EXTENT):
+    """Encode a tile from a dict of each layer's features."""
+    return b''.join(length_delimited(3, encode_layer(name, features, extent))
+                    for name, features in layers.items())
+
+
+def tile_size(z):
+    """The width of a tile at zoom `z`, in web mercator meters."""
+    return 2 * WEB_MERCATOR_EXTENT / 2 ** z
+
+
+def tile_bounds(z, x, y):
+    """The web mercator bounds of a tile, as (minx, miny, maxx, maxy)."""
+    size = tile_size(z)
+    minx = -WEB_MERCATOR_EXTENT + x * size
+    maxy = WEB_MERCATOR_EXTENT - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def tile_of(xs, ys, z):
+    """The column and row of the tiles at zoom `z` holding the given
+    web mercator points."""
+    size = tile_size(z)
+    last = 2 ** z - 1
+    tx = numpy.floor((numpy.asarray(xs) + WEB_MERCATOR_EXTENT) / size)
+    ty = numpy.floor((WEB_MERCATOR_EXTENT - numpy.asarray(ys)) / size)
+    return (numpy.clip(tx, 0, last).astype(int),
+            numpy.clip(ty, 0, last).astype(int))
+
+
+def to_tile_coords(coords, bounds, extent=EXTENT):
+    """Round web mercator coordinates to the tile coordinates of the tile
+    with the given bounds, with y pointing down."""
+    minx, miny, maxx, maxy = bounds
+    px = (coords[:, 0] - minx) * extent / (maxx - minx)
+    py = (maxy - coords[:, 1]) * extent / (maxy - miny)
+    return numpy.round(numpy.column_stack([px, py])).astype(numpy.int64)
+
+
+def point_features(xs, ys, properties, z, extent=EXTENT):
+    """
+    Sort the given web mercator points into the tiles at zoom `z`.
+    Returns a dict of the features in each tile, keyed by `(z, x, y)`,
+    each feature carrying the given `properties` of its point.
+    """
+    tx, ty = tile_of(xs, ys, z)
+    tiles = defaultdict(list)
+    coords = numpy.column_stack([xs, ys])
+    for i, (x, y) in enumerate(zip(tx, ty)):
+        point = to_tile_coords(coords[i:i + 1], tile_bounds(z, x, y), extent)
+        tiles[z, x, y].append((POINT, point_commands(point), properties[i]))
+    return tiles
@@ -0,0 +1,152 @@
+"""
+Run the stages of the map build in parallel, each as soon as the stages
+it depends on have finished.
+"""
+import os
+import time
+import queue
+import multiprocessing
+from contextlib import contextmanager
+
+
+@contextmanager
+def unmeasured(name, artifacts=()):
+    """Run a stage as it is, for builds that don't measure their stages."""
+    yield
+
+
+# The stages of the build in progress, keyed by name, for the workers of
+# a `StageScheduler` to look up, along with the context manager to run
+# them in. The workers are forked once the stages are all added, so they
+# inherit them, and a stage's function and arguments never have to be
+# pickled.
+_scheduled_stages = {}
+
+
+def run_scheduled_stage(name):
+    """Run the named stage; return when it started and finished."""
+    start = time.time()
+    func, args, artifacts, stage = _scheduled_stages[name]
+    with stage(name, artifacts):
+        func(*args)
+    return start, time.time()
+
+
+class StageScheduler:
+    """
+    Run the stages of a build as soon as the stages they depend on have
+    finished, up to `workers` at a time (by default, one per CPU; the
+    command line's watcher asks for one unless `--workers` is given).
+
+    The stages run in a pool of worker processes forked from the build,
+    so they share the data it has loaded, like the `Map` frames, copy-
+    on-write, without pickling it. All a stage can leave behind is the
+    files it writes. With one worker, or where processes can't be
+    forked, the stages run one after another in the build's process,
+    in the order they were added; in the latter case, `run` says so.
+
+    `report` prints when each stage ran, and the critical path: the
+    chain of dependent stages that took longest. However many workers
+    there are, the build can't take less time than that.
+
+    Each stage runs inside `stage(name, artifacts)`, in the process that
+    runs it; map.py passes its `stage`, which profiles the stage when
+    the build is being profiled.
+    """
+
+    def __init__(self, workers=None, stage=unmeasured):
+        self.workers = workers or os.cpu_count() or 1
+        self.stage = stage
+        self.stages = {}
+        self.times = {}
+
+    def add(self, name, func, *args, deps=(), artifacts=()):
+        """
+        Add a stage that calls `func(*args)`, and writes the files or
+        directories in `artifacts`, once the named stages in `deps` have
+        finished. Stages must be added after the stages they depend on;
+        dependencies on stages that weren't added are ignored.
+        """
+        deps = [dep for dep in deps if dep in self.stages]
+        self.stages[name] = (func, args, artifacts, deps)
+
+    def run(self):
+        _scheduled_stages.clear()
+        _scheduled_stages.update({
+            name: (func, args, artifacts, self.stage)
+            for name, (func, args, artifacts, deps) in self.stages.items()
+        })
+        if not self.stages:
+            return
+        forkable = 'fork' in multiprocessing.get_all_start_methods()
+        if self.workers == 1 or not forkable:
+            if self.workers > 1:
+                print("Can't fork worker processes on this platform; "
+                      "running the build's stages one at a time instead "
+                      f"of {self.workers} at once.")
+            for name in self.stages:
+                self.times[name] = run_scheduled_stage(name)
+            return
+
+        finished = queue.Queue()
+        waiting = dict(self.stages)
+        running = 0
+        workers = min(self.workers, len(self.stages))
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            while waiting or running:
+                ready = [name for name, (*_, deps) in waiting.items()
+                         if all(dep in self.times for dep in deps)]
+                for name in ready:
+                    del waiting[name]
+                    running += 1
+                    pool.apply_async(
+                        run_scheduled_stage, (name,),
+                        callback=lambda times, name=name:
+                            finished.put((name, times, None)),
+                        error_callback=lambda error, name=name:
+                            finished.put((name, None, error)),
+                    )
+
+                name, times, error = finished.get()
+                running -= 1
+                if error is not None:
+                    raise RuntimeError(f'build stage {name} failed') from error
+                self.times[name] = times
+
+    def critical_path(self):
+        """
+        Return the chain of stages, each depending on the one before,
+        whose times add up to the most, and that total in seconds.
+        """
+        longest = {}
+        for name, (*_, deps) in self.stages.items():
+            start, end = self.times[name]
+            before = max(deps, key=lambda dep: longest[dep][0], default=None)
+            total = end - start + (longest[before][0] if before else 0)
+            longest[name] = (total, before)
+
+        name = max(longest, key=lambda name: longest[name][0])
+        total = longest[name][0]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = longest[name][1]
+        return path[::-1], total
+
+    def report(self):
+        if not self.times:
+            return
+        build_start = min(start for start, _ in self.times.values())
+        build_end = max(end for _, end in self.times.values())
+        workers = min(self.workers, len(self.stages))
+        print(f"Build stages ({workers} worker{'s' * (workers != 1)}):")
+        for name, (start, end) in sorted(self.times.items(),
+                                         key=lambda item: item[1]):
+            print(f"  {name:<16} {start - build_start:8.2f}s "
+                  f"{end - build_start:8.2f}s {end - start:8.2f}s")
+
+        path, total = self.critical_path()
+        steps = [f"{name} ({self.times[name][1] - self.times[name][0]:.2f}s)"
+                 for name in path]
+        print(f"Critical path: {total:.2f}s of "
+              f"{build_end - build_start:.2f}s: " + " -> ".join(steps))
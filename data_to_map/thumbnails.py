@@ -0,0 +1,225 @@
+"""
+Draw the protests' PNG thumbnails straight from cached map tiles, without
+a browser, to look like the point maps Bokeh draws in map.py.
+
+The tiles are downloaded once into an on-disk cache, which the processes
+exporting the thumbnails share, and composited with Pillow.
+"""
+import os
+import math
+import hashlib
+import urllib.request
+from functools import lru_cache
+from pathlib import Path
+
+import numpy
+from PIL import Image, ImageDraw
+
+# The same as in map.py, which imports this module.
+TILE_SIZE = 256
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+
+class TileCache:
+    """
+    An on-disk cache of map tiles, laid out as `root/<source>/z/x/y`, so
+    that tiles shared by many thumbnails are downloaded only once. Each
+    tile source gets its own directory, named by a hash of its URL.
+
+    A tile's mtime records when it was last used. `evict` deletes the
+    least recently used tiles until the cache fits in `max_bytes`. It is
+    safe for several processes to add tiles to the same cache at once,
+    but only one should evict.
+    """
+
+    def __init__(self, tile_url, root='data_to_map/.tile-cache',
+                 max_bytes=512 * 2 ** 20):
+        self.tile_url = tile_url
+        source = hashlib.sha256(tile_url.encode('utf-8')).hexdigest()[:16]
+        self.root = Path(root) / source
+        self.max_bytes = max_bytes
+
+    def path(self, z, x, y):
+        return self.root / str(z) / str(x) / f'{y}.png'
+
+    def fetch(self, z, x, y):
+        url = self.tile_url.format(z=z, x=x, y=y)
+        request = urllib.request.Request(
+            url, headers={'User-Agent': 'spa-map-builder'}
+        )
+        with urllib.request.urlopen(request, timeout=30) as response:
+            data = response.read()
+
+        path = self.path(z, x, y)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as op:
+            op.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def get(self, z, x, y):
+        """
+        Return the path to the cached tile, downloading it first if
+        necessary.
+        """
+        path = self.path(z, x, y)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            path = self.fetch(z, x, y)
+        return path
+
+    def evict(self):
+        tiles = []
+        for path in self.root.glob('*/*/*.png'):
+            stat = path.stat()
+            tiles.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in tiles)
+        for _, size, path in sorted(tiles):
+            if total <= self.max_bytes:
+                break
+            path.unlink()
+            total -= size
+
+
+@lru_cache(maxsize=256)
+def load_tile(cache, z, x, y):
+    # Many protests share a location, so decoded tiles are worth keeping
+    # in memory too.
+    with Image.open(cache.get(z, x, y)) as tile:
+        return tile.convert('RGB')
+
+
+def tile_zoom_for(x_range, width_px, max_zoom=18):
+    """
+    Return the zoom level whose tile resolution is closest to that of a
+    view `x_range` meters wide drawn `width_px` pixels wide. This is the
+    level Bokeh's tile renderer would choose.
+    """
+    view_res = (x_range[1] - x_range[0]) / width_px
+    tile_res = 2 * WEB_MERCATOR_EXTENT / TILE_SIZE
+    zoom = round(math.log2(tile_res / view_res))
+    return max(0, min(zoom, max_zoom))
+
+
+def render_tiles(cache, x_range, y_range, size):
+    """
+    Composite the cached tiles that cover the given web mercator ranges
+    into an image of `size` (width, height) pixels.
+    """
+    zoom = tile_zoom_for(x_range, size[0])
+    scale = TILE_SIZE * 2 ** zoom / (2 * WEB_MERCATOR_EXTENT)
+
+    # Global pixel coordinates at this zoom level, with y pointing down.
+    left = (x_range[0] + WEB_MERCATOR_EXTENT) * scale
+    right = (x_range[1] + WEB_MERCATOR_EXTENT) * scale
+    top = (WEB_MERCATOR_EXTENT - y_range[1]) * scale
+    bottom = (WEB_MERCATOR_EXTENT - y_range[0]) * scale
+
+    n_tiles = 2 ** zoom
+    tx0, tx1 = int(left // TILE_SIZE), int(math.ceil(right / TILE_SIZE))
+    ty0, ty1 = int(top // TILE_SIZE), int(math.ceil(bottom / TILE_SIZE))
+
+    mosaic = Image.new('RGB', ((tx1 - tx0) * TILE_SIZE,
+                               (ty1 - ty0) * TILE_SIZE), 'white')
+    for tx in range(tx0, tx1):
+        for ty in range(max(ty0, 0), min(ty1, n_tiles)):
+            tile = load_tile(cache, zoom, tx % n_tiles, ty)
+            mosaic.paste(tile, ((tx - tx0) * TILE_SIZE,
+                                (ty - ty0) * TILE_SIZE))
+
+    box = (left - tx0 * TILE_SIZE, top - ty0 * TILE_SIZE,
+           right - tx0 * TILE_SIZE, bottom - ty0 * TILE_SIZE)
+    return mosaic.resize(size, Image.BILINEAR, box=box)
+
+
+# Markers are drawn at this multiple of their final size and then
+# scaled down, which gives us antialiasing for free.
+MARKER_SUPERSAMPLE = 4
+
+
+@lru_cache(maxsize=None)
+def marker_sprite(marker, size, fill, fill_alpha,
+                  line, line_alpha, line_width):
+    """
+    Draw a single marker, matching the appearance of the Bokeh Scatter
+    glyphs in map.py's `individual_point_map`, as an RGBA image centered on its
+    middle pixel.
+    """
+    ss = MARKER_SUPERSAMPLE
+    extent = int(size + line_width + 2) | 1
+    center = extent * ss / 2
+    radius = size * ss / 2
+
+    fill_layer = Image.new('RGBA', (extent * ss, extent * ss))
+    line_layer = Image.new('RGBA', (extent * ss, extent * ss))
+    if marker == 'circle':
+        bbox = (center - radius, center - radius,
+                center + radius, center + radius)
+        ImageDraw.Draw(fill_layer).ellipse(bbox, fill=fill)
+        ImageDraw.Draw(line_layer).ellipse(bbox, outline=line,
+                                           width=line_width * ss)
+    elif marker == 'star':
+        angles = numpy.pi / 2 + numpy.arange(10) * numpy.pi / 5
+        radii = numpy.where(numpy.arange(10) % 2, radius * 0.382, radius)
+        points = list(zip(center + radii * numpy.cos(angles),
+                          center - radii * numpy.sin(angles)))
+        ImageDraw.Draw(fill_layer).polygon(points, fill=fill)
+        ImageDraw.Draw(line_layer).line(points + points[:1], fill=line,
+                                        width=line_width * ss)
+    else:
+        raise ValueError(f'unknown marker {marker!r}')
+
+    # Apply the alphas to each layer separately, as Bokeh does.
+    sprite = Image.new('RGBA', fill_layer.size)
+    for layer, alpha in ((fill_layer, fill_alpha), (line_layer, line_alpha)):
+        a = numpy.asarray(layer)[..., 3].astype(float) * alpha
+        layer.putalpha(Image.fromarray(a.astype(numpy.uint8)))
+        sprite = Image.alpha_composite(sprite, layer)
+    return sprite.resize((extent, extent), Image.LANCZOS)
+
+
+def draw_marker(image, sprite, x, y):
+    half = sprite.size[0] // 2
+    left, top = int(round(x)) - half, int(round(y)) - half
+    # alpha_composite doesn't clip, so skip markers that hang off the edge
+    # by cropping the sprite to the visible part.
+    crop = (max(0, -left), max(0, -top),
+            min(sprite.size[0], image.size[0] - left),
+            min(sprite.size[1], image.size[1] - top))
+    if crop[0] >= crop[2] or crop[1] >= crop[3]:
+        return
+    image.alpha_composite(sprite.crop(crop),
+                          (left + crop[0], top + crop[1]))
+
+
+def static_point_map(cache, xs, ys, selected_ix, x_range, y_range,
+                     size=(600, 700)):
+    """
+    Draw the same picture as map.py's `individual_point_map`, without a
+    browser:
+    composite the map tiles, then draw every protest in view as a circle
+    and the selected protest as a star.
+    """
+    image = render_tiles(cache, x_range, y_range, size).convert('RGBA')
+
+    # Convert from web mercator to image pixels, all at once.
+    px = (xs - x_range[0]) / (x_range[1] - x_range[0]) * size[0]
+    py = (y_range[1] - ys) / (y_range[1] - y_range[0]) * size[1]
+    margin = 20
+    in_view = ((px > -margin) & (px < size[0] + margin) &
+               (py > -margin) & (py < size[1] + margin))
+
+    circle = marker_sprite('circle', 12, (128, 0, 128), 0.5,
+                           (128, 0, 128), 0.5, 1)
+    star = marker_sprite('star', 12, (128, 0, 128), 0.8,
+                         (255, 0, 0), 0.5, 7)
+
+    for i in numpy.flatnonzero(in_view):
+        if i != selected_ix:
+            draw_marker(image, circle, px[i], py[i])
+    draw_marker(image, star, px[selected_ix], py[selected_ix])
+
+    return image.convert('RGB')
@@ -0,0 +1,188 @@
+"""
+Watch the map's input data and code, and rebuild the map when they
+change: through inotify where it's available, and otherwise by polling.
+"""
+import os
+import sys
+import time
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+from pathlib import Path
+
+
+class InotifyWatcher:
+    """
+    Wait for files to change using the Linux inotify interface. We call
+    into libc with ctypes, so this needs no extra packages; on systems
+    without inotify, creating a watcher raises OSError.
+
+    Each watched directory can be restricted to a set of file names. The
+    watcher reports only events for those names, so that writes to other
+    files (like the build state, or __pycache__) don't wake it up.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    EVENT_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, watch_dirs):
+        """
+        `watch_dirs` maps directory paths to a collection of file names
+        to watch in that directory, or None to watch every file.
+        """
+        libc_name = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(libc_name, use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError) as exc:
+            raise OSError('inotify is not available') from exc
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.names = {}
+        for path, names in watch_dirs.items():
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(str(path)), self.EVENT_MASK
+            )
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, os.strerror(errno), str(path))
+            self.names[wd] = None if names is None else set(names)
+
+    def close(self):
+        os.close(self.fd)
+
+    def wait(self, timeout=None):
+        """
+        Block until there are relevant events or `timeout` seconds pass.
+        Returns the names of the files that changed, which is empty if
+        we timed out.
+        """
+        changed = set()
+        end = None if timeout is None else time.monotonic() + timeout
+        while not changed:
+            remaining = None if end is None else end - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if readable:
+                changed.update(self.read_events())
+        return changed
+
+    def read_events(self):
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(
+                buf, offset
+            )
+            offset += self.EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            name = os.fsdecode(name)
+            wanted = self.names.get(wd)
+            if wanted is None or name in wanted:
+                names.append(name)
+        return names
+
+
+def listen_for_sigterm(listen, default_sigterm):
+    """
+    While we are waiting for changes, exit as soon as docker sends
+    SIGTERM; while we are working, fall back to the default handler.
+    """
+    if listen:
+        signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    else:
+        signal.signal(signal.SIGTERM, default_sigterm)
+
+
+def watch_inotify(watcher, rebuild, default_sigterm, debounce=0.5):
+    """
+    Call `rebuild` whenever `watcher` reports a change.
+
+    Editors and spreadsheet exports often write a file in several
+    chunks, or write a temporary file and rename it. So after the first
+    event we keep collecting events until things have been quiet for
+    `debounce` seconds, and then rebuild once. Events that arrive during
+    a rebuild queue up in the kernel, and are handled together after the
+    rebuild finishes; rebuilds never overlap.
+    """
+    print("Watching input directory for changes.")
+    try:
+        while True:
+            listen_for_sigterm(True, default_sigterm)
+            changed = watcher.wait()
+            while True:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+            listen_for_sigterm(False, default_sigterm)
+
+            print("Change detected in " + ", ".join(sorted(changed)))
+            if rebuild():
+                print("Map generation complete.")
+                print("Watching for changes...")
+    finally:
+        watcher.close()
+
+
+def watch_polling(rebuild, default_sigterm, data_dir, code_files,
+                  interval=10):
+    """
+    Call `rebuild` whenever a file in `data_dir` or one of `code_files`
+    changes, by checking modification times every `interval` seconds.
+    This is slower to notice changes than `watch_inotify`, but works
+    everywhere -- including on docker volumes mounted from macOS or
+    Windows hosts, which don't deliver inotify events for changes made
+    on the host.
+    """
+    # We set these variables to keep track of changes
+    last_mod_time = 0
+    new_mod_time = 0
+    init = True
+    print(f"Watching input directory for changes every {interval} seconds.")
+    while True:
+        data_files = list(Path(data_dir).iterdir())
+        data_files.extend(Path(path).resolve() for path in code_files)
+        for data_file in data_files:
+            mod_time = os.path.getmtime(data_file)
+            if mod_time > new_mod_time:
+                new_mod_time = mod_time
+
+        if init:
+            init = False
+            last_mod_time = new_mod_time
+
+        if new_mod_time > last_mod_time:
+            last_mod_time = new_mod_time
+            if rebuild():
+                print("Map generation complete.")
+                print("Watching for changes...")
+
+        # Listen for SIGTERM from docker while sleeping.
+        listen_for_sigterm(True, default_sigterm)
+        time.sleep(interval)
+        # Ignore SIGTERM while working.
+        listen_for_sigterm(False, default_sigterm)